@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+##############################################################################
+'''
+Description:    Runs many of the Opsview/Nagios plugins in this directory
+                from one long-lived Python process.  Plugin scripts are
+                compiled once and each check runs main() in a fresh copy
+                of the plugin's module on a bounded thread pool driven by
+                asyncio, so each check skips interpreter start-up and
+                re-importing boto3, paramiko, googleapiclient and friends
+                while module globals stay private to that check.  The sys.exit() from
+                send_ok/send_warning/send_critical/send_unknown is caught
+                and turned into a Result, which is submitted as a passive
+                check result or written out as JSON lines.
+Requirements:   Whatever the plugins being run require
+Created:        2026-10-18
+Author:         Bo Smith (bo@bosmith.tech)
+'''
+##############################################################################
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import shlex
+import sys
+import threading
+import time
+import types
+
+ok = 0
+warn = 1
+crit = 2
+unknown = 3
+states = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+plugin_dir = os.path.dirname(os.path.abspath(__file__))
+
+Check = collections.namedtuple('Check', ['host', 'service', 'argv'])
+Result = collections.namedtuple(
+    'Result', ['host', 'service', 'code', 'output', 'duration'])
+
+
+# Get arguments
+##############################################################################
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='Run Opsview/Nagios plugins concurrently in one process')
+    parser.add_argument(
+        '-f',
+        '--checks',
+        action='store',
+        required=True,
+        help='File with one "HOST;SERVICE;PLUGIN ARGS" per line, # for comments\n'
+        ' i.e. web01;CPU Load;check_ssh_linux_load -H web01 -u opsview -r'
+    )
+    parser.add_argument(
+        '-n',
+        '--concurrency',
+        action='store',
+        default=100,
+        type=int,
+        required=False,
+        help='Checks to run at the same time (Default 100)'
+    )
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        action='store',
+        default=60,
+        type=int,
+        required=False,
+        help='Seconds before a check is reported UNKNOWN (Default 60)'
+    )
+    parser.add_argument(
+        '-i',
+        '--interval',
+        action='store',
+        default=0,
+        type=int,
+        required=False,
+        help='Seconds between cycles, 0 runs a single cycle (Default 0)'
+    )
+    parser.add_argument(
+        '--command-file',
+        action='store',
+        required=False,
+        help='Nagios command pipe to submit passive results to\n'
+        ' i.e. /opt/opsview/monitoringscripts/var/rw/nagios.cmd'
+    )
+    parser.add_argument(
+        '--results-file',
+        action='store',
+        required=False,
+        help='Append passive results to this file instead of the command pipe'
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        default=False,
+        required=False,
+        help='Enable debug logging'
+    )
+    args = parser.parse_args()
+    return(args)
+
+
+# Per-thread sys.argv, sys.stdout and sys.stderr
+##############################################################################
+class ThreadArgv(list):
+    '''
+    Plugins read their arguments from sys.argv through argparse, so every
+    worker thread gets its own view of it.  Threads without one see the
+    runner's real arguments.
+    '''
+
+    def __init__(self, argv):
+        list.__init__(self, argv)
+        self.local = threading.local()
+
+    def current(self):
+        return(getattr(self.local, 'argv', None))
+
+    def __getitem__(self, key):
+        argv = self.current()
+        if argv is None:
+            return(list.__getitem__(self, key))
+        return(argv[key])
+
+    def __len__(self):
+        argv = self.current()
+        if argv is None:
+            return(list.__len__(self))
+        return(len(argv))
+
+    def __iter__(self):
+        argv = self.current()
+        if argv is None:
+            return(list.__iter__(self))
+        return(iter(argv))
+
+
+class ThreadStream(object):
+    '''Sends output from a worker thread to that check's own buffer'''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def current(self):
+        buffer = getattr(self.local, 'buffer', None)
+        return(self.stream if buffer is None else buffer)
+
+    def write(self, data):
+        return(self.current().write(data))
+
+    def flush(self):
+        return(self.current().flush())
+
+    def __getattr__(self, name):
+        return(getattr(self.stream, name))
+
+
+# Compile a plugin script once so each run only has to execute it
+##############################################################################
+def load_plugin(name):
+    path = os.path.join(plugin_dir, name)
+    with open(path) as f:
+        source = f.read()
+    # Older plugins do all their work at module level, importing one of
+    # those would run the check rather than load it
+    if '__name__' not in source:
+        raise Exception('{} runs at import time and can not be run '
+                        'in-process'.format(name))
+    return(compile(source, path, 'exec'))
+
+
+# A fresh module for one run of a plugin
+##############################################################################
+def new_plugin(name, code):
+    # Plugins keep results in module globals (i.e. the status list in
+    # check_gcp_compute_snapshot), so sharing one module between runs would
+    # mix one check's results into another's.  The plugin's own imports are
+    # already in sys.modules, so this only re-runs its module level code.
+    plugin = types.ModuleType(name)
+    plugin.__file__ = code.co_filename
+    exec(code, plugin.__dict__)
+    if not hasattr(plugin, 'main'):
+        raise Exception('{} has no main() to call'.format(name))
+    return(plugin)
+
+
+# Read the check definitions
+##############################################################################
+def get_checks(path):
+    checks = []
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                host, service, command = line.split(';', 2)
+                argv = shlex.split(command)
+                argv[0] = os.path.basename(argv[0])
+                checks.append(Check(host.strip(), service.strip(), argv))
+    except (IOError, ValueError, IndexError) as err:
+        logging.error('Unable to read checks from %s %s', path, str(err))
+        sys.exit(unknown)
+    return(checks)
+
+
+# The runner
+##############################################################################
+class CheckRunner(object):
+
+    def __init__(self, concurrency, timeout):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.plugins = {}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency)
+        # One per pool thread, held until the plugin really returns, even
+        # after its check has been reported as timed out
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.argv = ThreadArgv(sys.argv)
+        self.stdout = ThreadStream(sys.stdout)
+        self.stderr = ThreadStream(sys.stderr)
+        sys.argv = self.argv
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+
+    def get_plugin(self, name):
+        # Compile each plugin once, the first check to need it pays for it
+        with self.lock:
+            if name not in self.plugins:
+                self.plugins[name] = load_plugin(name)
+            code = self.plugins[name]
+        return(new_plugin(name, code))
+
+    def run_plugin(self, check):
+        buffer = io.StringIO()
+        self.argv.local.argv = check.argv
+        # argparse usage errors go to stderr, keep them with the output
+        self.stdout.local.buffer = buffer
+        self.stderr.local.buffer = buffer
+        try:
+            plugin = self.get_plugin(check.argv[0])
+            plugin.main()
+            # Returning without calling one of the send_* functions is not
+            # something Opsview would accept either
+            code = unknown
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else unknown
+        except Exception as err:
+            buffer.write('UNKNOWN - {} failed {}\n'.format(
+                check.argv[0], str(err)))
+            code = unknown
+        finally:
+            self.argv.local.argv = None
+            self.stdout.local.buffer = None
+            self.stderr.local.buffer = None
+        if code not in (ok, warn, crit, unknown):
+            code = unknown
+        output = buffer.getvalue().strip()
+        if not output:
+            output = '{} - {} returned no output'.format(
+                states[code], check.argv[0])
+        return(code, output)
+
+    def run_slot(self, check):
+        try:
+            return(self.run_plugin(check))
+        finally:
+            self.slots.release()
+
+    async def get_slot(self):
+        # Checks that timed out still hold their threads, only hand work to
+        # the pool once one is really free so it never sits in the queue
+        # with its timeout running
+        start = time.time()
+        while not self.slots.acquire(blocking=False):
+            if time.time() - start >= self.timeout:
+                return(False)
+            await asyncio.sleep(0.1)
+        return(True)
+
+    async def run_check(self, check, semaphore):
+        async with semaphore:
+            if not await self.get_slot():
+                logging.warning('No free worker for %s %s', check.host,
+                                check.service)
+                return(Result(check.host, check.service, unknown,
+                              'UNKNOWN - No free worker after {} seconds, '
+                              'earlier checks are still running past their '
+                              'timeout'.format(self.timeout), self.timeout))
+            start = time.time()
+            future = self.pool.submit(self.run_slot, check)
+            try:
+                code, output = await asyncio.wait_for(
+                    asyncio.wrap_future(future), self.timeout)
+            except asyncio.TimeoutError:
+                # The worker thread can not be killed, it finishes in the
+                # background, gives its slot back and its result is dropped
+                if future.cancelled():
+                    self.slots.release()
+                code = unknown
+                output = 'UNKNOWN - Check timed out after {} seconds'.format(
+                    self.timeout)
+        return(Result(check.host, check.service, code, output,
+                      time.time() - start))
+
+    async def run_all(self, checks):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [self.run_check(check, semaphore) for check in checks]
+        return(await asyncio.gather(*tasks))
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+
+# Write out the results
+##############################################################################
+def submit_results(args, results):
+    now = int(time.time())
+    if args.command_file or args.results_file:
+        target = args.command_file or args.results_file
+        lines = []
+        for result in results:
+            # Nagios only takes the first line in a passive result
+            lines.append('[{}] PROCESS_SERVICE_CHECK_RESULT;{};{};{};{}\n'.format(
+                now, result.host, result.service, result.code,
+                result.output.split('\n')[0]))
+        try:
+            with open(target, 'a') as f:
+                f.write(''.join(lines))
+        except IOError as err:
+            logging.error('Unable to write results to %s %s', target, str(err))
+    else:
+        for result in results:
+            print(json.dumps(result._asdict()))
+        sys.stdout.flush()
+
+
+# Git-r-done!
+##############################################################################
+def main():
+    args = get_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    checks = get_checks(args.checks)
+    runner = CheckRunner(args.concurrency, args.timeout)
+    try:
+        while True:
+            start = time.time()
+            results = asyncio.run(runner.run_all(checks))
+            submit_results(args, results)
+            counts = collections.Counter(states[r.code] for r in results)
+            logging.info('Ran %s checks in %.1f seconds %s', len(results),
+                         time.time() - start, dict(counts))
+            if not args.interval:
+                break
+            time.sleep(max(0, args.interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        runner.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+##############################################################################
+'''
+Description:    Shared CloudWatch collection layer for the
+                check_aws_cloudwatch_* plugins.  Requests shaped like
+                get_metric_statistics() are queued, merged with any other
+                requests for the same credentials and time window (from
+                the same check, or from other checks when they run in
+                check_runner.py) and fetched with GetMetricData, up to 500
+                queries per call.  Each caller gets back a response in the
+                get_metric_statistics() layout so the plugins' existing
+                Datapoints handling and process_metrics_gt/lt keep working.
+                One boto3 client is kept per region and credential set.
+                Results are also kept in a short-TTL SQLite cache shared by
+                every plugin process on the collector, and a miss can
+                prefetch the other metrics of the same resource so the rest
+                of the services on it are answered from the cache.
+Requirements:   boto3
+Created:        2026-10-18
+Author:         Bo Smith (bo@bosmith.tech)
+'''
+##############################################################################
+import contextlib
+import datetime
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import boto3
+
+# GetMetricData accepts at most 500 queries per call
+max_queries = 500
+# Seconds the first request waits for others to join its batch, only
+# matters when several checks share the process
+batch_window = float(os.environ.get('CLOUDWATCH_BATCH_WINDOW', '0.05'))
+
+# Shared result cache, a TTL of 0 turns it off
+cache_path = os.environ.get('CLOUDWATCH_CACHE',
+                            '/var/tmp/opsview_cloudwatch_cache.db')
+# Entries never expire before their own period, and the default covers the
+# usual 5 minute check interval so a prefetch is not thrown away unused.
+# Keys include the period the window ends in, so nothing from an earlier
+# period is ever served.
+cache_ttl = float(os.environ.get('CLOUDWATCH_CACHE_TTL', '300'))
+cache_size = int(os.environ.get('CLOUDWATCH_CACHE_SIZE', '20000'))
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+# One client per region and credential set
+##############################################################################
+def get_client(args):
+    secret = hashlib.sha256(str(args.secretkey).encode()).hexdigest()
+    key = (args.region, args.accesskey, secret)
+    # boto3's default session is not thread safe while creating clients,
+    # the clients themselves are
+    with clients_lock:
+        if key not in clients:
+            clients[key] = boto3.client('cloudwatch',
+                                        aws_access_key_id=args.accesskey,
+                                        aws_secret_access_key=args.secretkey,
+                                        region_name=args.region)
+        return(key, clients[key])
+
+
+# Align windows so requests made moments apart can share a call
+##############################################################################
+def floor_minute(timestamp):
+    return(timestamp.replace(second=0, microsecond=0))
+
+
+# A single GetMetricData call (and its pages)
+##############################################################################
+class MetricBatch(object):
+
+    def __init__(self, client, starttime, endtime):
+        self.client = client
+        self.starttime = starttime
+        self.endtime = endtime
+        self.queries = {}
+        self.ids = {}
+        self.results = {}
+        self.status = None
+        self.error = None
+        self.done = threading.Event()
+
+    def full(self):
+        return(len(self.queries) >= max_queries)
+
+    def add(self, query):
+        # Identical queries from different checks share one query id
+        key = (
+            query['Namespace'],
+            query['MetricName'],
+            tuple(sorted((d['Name'], d['Value']) for d in query['Dimensions'])),
+            query['Period'],
+            query['Statistic']
+        )
+        if key not in self.ids:
+            qid = 'q'+str(len(self.ids))
+            self.ids[key] = qid
+            self.queries[qid] = {
+                'Id': qid,
+                'MetricStat': {
+                    'Metric': {
+                        'Namespace': query['Namespace'],
+                        'MetricName': query['MetricName'],
+                        'Dimensions': query['Dimensions']
+                    },
+                    'Period': query['Period'],
+                    'Stat': query['Statistic']
+                },
+                'ReturnData': True
+            }
+        return(self.ids[key])
+
+    def fetch(self):
+        try:
+            kwargs = {
+                'MetricDataQueries': list(self.queries.values()),
+                'StartTime': self.starttime,
+                'EndTime': self.endtime,
+                'ScanBy': 'TimestampDescending'
+            }
+            while True:
+                response = self.client.get_metric_data(**kwargs)
+                self.status = response['ResponseMetadata']['HTTPStatusCode']
+                # Long series can be split over pages, stitch them back up
+                for result in response['MetricDataResults']:
+                    series = self.results.setdefault(result['Id'], [])
+                    series.extend(zip(result['Timestamps'], result['Values']))
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        except Exception as err:
+            self.error = err
+        finally:
+            self.done.set()
+
+    def result(self, qid):
+        if self.error is not None:
+            raise self.error
+        metric = self.queries[qid]['MetricStat']['Metric']['MetricName']
+        statistic = self.queries[qid]['MetricStat']['Stat']
+        datapoints = []
+        for timestamp, value in self.results.get(qid, []):
+            datapoints.append({'Timestamp': timestamp, statistic: value})
+        return({
+            'Label': metric,
+            'Datapoints': datapoints,
+            'ResponseMetadata': {'HTTPStatusCode': self.status}
+        })
+
+
+# Coalesces requests from concurrent checks into shared batches
+##############################################################################
+class MetricBatcher(object):
+
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, args, queries):
+        key, client = get_client(args)
+        batches = []
+        with self.lock:
+            for query in queries:
+                group = (key, query['StartTime'], query['EndTime'])
+                batch = self.pending.get(group)
+                leader = batch is None or batch.full()
+                if leader:
+                    batch = MetricBatch(client, query['StartTime'],
+                                        query['EndTime'])
+                    self.pending[group] = batch
+                qid = batch.add(query)
+                batches.append((batch, qid, group, leader))
+        # Whoever opened a batch sends it once the window closes, everyone
+        # else waits on it
+        for batch, qid, group, leader in batches:
+            if leader:
+                if self.window:
+                    time.sleep(self.window)
+                with self.lock:
+                    if self.pending.get(group) is batch:
+                        del self.pending[group]
+                batch.fetch()
+        responses = []
+        for batch, qid, group, leader in batches:
+            batch.done.wait()
+            responses.append(batch.result(qid))
+        return(responses)
+
+
+batcher = MetricBatcher(batch_window)
+
+
+# Short-TTL result cache shared between plugin processes
+##############################################################################
+class MetricCache(object):
+    '''
+    SQLite does the file locking between processes, entries expire after
+    the TTL and the least recently used ones are dropped past the size cap.
+    '''
+
+    def __init__(self, path, ttl, size):
+        self.path = path
+        self.ttl = ttl
+        self.size = size
+        self.local = threading.local()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.lock_file = None
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS metrics ('
+                       'key TEXT PRIMARY KEY, response TEXT, '
+                       'expires REAL, used REAL)')
+            db.execute('CREATE INDEX IF NOT EXISTS metrics_used '
+                       'ON metrics (used)')
+            self.local.db = db
+        return(db)
+
+    def get_key(self, args, query):
+        return(json.dumps([
+            args.region,
+            args.accesskey,
+            query['Namespace'],
+            query['MetricName'],
+            sorted((d['Name'], d['Value']) for d in query['Dimensions']),
+            query['Period'],
+            query['Statistics'][0],
+            # Lookback length, so a long --starttime is not served a short one
+            int((query['EndTime'] - query['StartTime']).total_seconds()),
+            # Period the window ends in, a new period always misses so an
+            # entry is never older than the datapoints it stands in for
+            int(query['EndTime'].timestamp()) // query['Period']
+        ]))
+
+    def get(self, key):
+        now = time.time()
+        db = self.connect()
+        row = db.execute('SELECT response FROM metrics '
+                         'WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        if row is None:
+            return(None)
+        db.execute('UPDATE metrics SET used = ? WHERE key = ?', (now, key))
+        response = json.loads(row[0])
+        for datapoint in response['Datapoints']:
+            datapoint['Timestamp'] = datetime.datetime.fromisoformat(
+                datapoint['Timestamp'])
+        return(response)
+
+    def put(self, items):
+        now = time.time()
+        rows = []
+        for key, response, period in items:
+            # Only successful calls are worth handing to other checks
+            if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+                continue
+            rows.append((key, json.dumps(response, default=str),
+                         now + max(self.ttl, period), now))
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?)',
+                           rows)
+            db.execute('DELETE FROM metrics WHERE expires <= ?', (now,))
+            db.execute('DELETE FROM metrics WHERE key IN ('
+                       'SELECT key FROM metrics ORDER BY used DESC '
+                       'LIMIT -1 OFFSET ?)', (self.size,))
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        # One check per resource fetches on a miss, the others wait here and
+        # then find the entries it stored.  lockf() only keeps other
+        # processes out, so threads in check_runner.py queue on a thread
+        # lock first, and the lock file stays open since closing any
+        # descriptor on it drops every lock the process holds.
+        offset = int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) % 65536
+        with self.locks_lock:
+            if self.lock_file is None:
+                self.lock_file = open(self.path+'.lock', 'a')
+            thread_lock = self.locks.setdefault(offset, threading.Lock())
+        with thread_lock:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX, 1, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN, 1, offset)
+
+
+cache = MetricCache(cache_path, cache_ttl, cache_size) if cache_ttl > 0 else None
+
+
+# Drop-in replacements for client.get_metric_statistics()
+##############################################################################
+def fetch_metric_statistics(args, queries):
+    requests = []
+    for query in queries:
+        requests.append({
+            'Namespace': query['Namespace'],
+            'MetricName': query['MetricName'],
+            'Dimensions': query['Dimensions'],
+            'StartTime': floor_minute(query['StartTime']),
+            'EndTime': floor_minute(query['EndTime']),
+            'Period': query['Period'],
+            'Statistic': query['Statistics'][0]
+        })
+    return(batcher.fetch(args, requests))
+
+
+def get_cached(args, queries, prefetch):
+    keys = [cache.get_key(args, query) for query in queries]
+    responses = [cache.get(key) for key in keys]
+    if None not in responses:
+        return(responses)
+    resource = json.dumps([args.region, args.accesskey,
+                           queries[0]['Namespace'],
+                           queries[0]['Dimensions']], sort_keys=True)
+    with cache.lock(resource):
+        # Another process may have filled it while we waited on the lock
+        responses = [cache.get(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if not missing:
+            return(responses)
+        fetch = [queries[i] for i in missing]
+        fetch_keys = [keys[i] for i in missing]
+        for metric in prefetch or []:
+            extra = dict(queries[0], MetricName=metric)
+            key = cache.get_key(args, extra)
+            if key not in fetch_keys and key not in keys and cache.get(key) is None:
+                fetch.append(extra)
+                fetch_keys.append(key)
+        fetched = fetch_metric_statistics(args, fetch)
+        try:
+            cache.put(list(zip(fetch_keys, fetched,
+                               [query['Period'] for query in fetch])))
+        except sqlite3.Error:
+            pass
+    for i, response in zip(missing, fetched):
+        responses[i] = response
+    return(responses)
+
+
+def get_metric_statistics_many(args, queries, prefetch=None):
+    '''
+    Fetch several get_metric_statistics() style queries in one batch.  Each
+    query takes the same keyword names as boto3 with a single statistic.
+    On a cache miss the metric names in prefetch are fetched along with
+    them for the same dimensions and stored for the next checks.
+    '''
+    if cache is None:
+        return(fetch_metric_statistics(args, queries))
+    try:
+        return(get_cached(args, queries, prefetch))
+    except (sqlite3.Error, OSError):
+        # A cache problem should never fail the check itself
+        return(fetch_metric_statistics(args, queries))
+
+
+def get_metric_statistics(args, prefetch=None, **query):
+    return(get_metric_statistics_many(args, [query], prefetch)[0])
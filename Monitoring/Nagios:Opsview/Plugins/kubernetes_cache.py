@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+##############################################################################
+'''
+Description:    In-memory cache of the check_kubernetes cluster snapshots.
+                check_runner.py runs every check in a fresh copy of the
+                plugin's module, so anything kept in the plugin itself is
+                gone after one check.  This module is imported normally and
+                stays loaded, so every check in the runner process answers
+                from the same snapshot until it expires and only the check
+                that refreshes it goes back to --cache-dir.
+Requirements:   None
+Created:        2026-10-18
+Author:         Bo Smith (bo@bosmith.tech)
+'''
+##############################################################################
+import threading
+import time
+
+# Snapshots keyed by their cache file, replaced whole and never changed in
+# place so threads can read them without holding the lock
+snapshots = {}
+lock = threading.Lock()
+
+
+# Snapshot for a cache file while it is still fresh
+##############################################################################
+def get(cache, ttl):
+    with lock:
+        snapshot = snapshots.get(cache)
+    if snapshot and time.time() - snapshot['updated'] < ttl:
+        return(snapshot)
+    return(None)
+
+
+def put(cache, snapshot):
+    with lock:
+        snapshots[cache] = snapshot
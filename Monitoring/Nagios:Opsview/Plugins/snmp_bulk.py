@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+##############################################################################
+'''
+Description:    GETBULK table collection for the check_snmp_* plugins.
+                Several columns of a MIB table are requested in one
+                GETBULK, max_repetitions rows at a time, so a PDU with any
+                number of banks, phases or sensors is read in one or two
+                round trips instead of a walk plus a GET per row.
+Requirements:   python-netsnmp, the MIBs the plugin loads
+Created:        2026-10-18
+Author:         Bo Smith (bo@bosmith.tech)
+'''
+##############################################################################
+import netsnmp
+
+# Rows per column asked for in each GETBULK, agents may send back fewer
+max_repetitions = 25
+# Varbind types that mean a column has run off the end of the agent's MIB
+end_types = ('ENDOFMIBVIEW', 'NOSUCHOBJECT', 'NOSUCHINSTANCE')
+# error-status the agent returns when a response will not fit in a message
+too_big = 1
+
+
+class SNMPError(Exception):
+    pass
+
+
+# Did the agent refuse the request as too big for one response
+##############################################################################
+def is_too_big(session):
+    return(session.ErrorNum == too_big or 'tooBig' in session.ErrorStr)
+
+
+# Read whole table columns with GETBULK
+##############################################################################
+def get_table(session, columns, repetitions=max_repetitions):
+    '''
+    Fetch the given columns (i.e. "PowerNet-MIB::rPDU2BankStatusCurrent")
+    of one table.  Returns {index: {column: value}} in the agent's row order
+    with the column names as the MIB spells them and the values decoded.
+    An agent that answers tooBig is asked again for half as many rows.
+    '''
+    names = [column.split('::')[-1] for column in columns]
+    last = ['' for column in columns]
+    rows = {}
+    active = list(range(len(columns)))
+    while active:
+        varlist = netsnmp.VarList(
+            *[netsnmp.Varbind(columns[i], last[i]) for i in active])
+        session.getbulk(0, repetitions, varlist)
+        if session.ErrorStr:
+            if is_too_big(session) and repetitions > 1:
+                repetitions = repetitions // 2
+                continue
+            raise SNMPError(session.ErrorStr)
+        # Varbinds come back a row at a time, one per requested column
+        finished = set()
+        progressed = set()
+        for n, varbind in enumerate(varlist):
+            i = active[n % len(active)]
+            if i in finished:
+                continue
+            # Past the last row the agent moves on to the next column
+            if varbind.tag != names[i] or varbind.type in end_types:
+                finished.add(i)
+                continue
+            value = varbind.val
+            if isinstance(value, bytes):
+                value = value.decode()
+            rows.setdefault(varbind.iid, {})[names[i]] = value
+            last[i] = varbind.iid
+            progressed.add(i)
+        # A column that returned nothing new is done too, so a short or odd
+        # response can never loop forever
+        active = [i for i in active if i in progressed and i not in finished]
+    return(rows)
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+##############################################################################
+'''
+Description:    Polls APC and Geist PDUs for the check_snmp_apcpdu_* and
+                check_snmp_geist_* services in one pass per PDU.  Services
+                are grouped by PDU and credentials, one netsnmp session is
+                opened per PDU per cycle and each table those services
+                need (bank, device, phase, sensor) is read with its own
+                snmp_bulk.get_table() call, small enough for embedded
+                agents to answer.  Each service is then evaluated with the
+                same thresholds and output as its plugin and submitted as a
+                passive result.  Running as one long-lived process means
+                the MIBs are parsed once, and the tables for each mix of
+                services are worked out once.
+Requirements:   python-netsnmp, POWERNET and Geist MIBs, snmp_bulk.py,
+                check_runner.py
+Created:        2026-10-18
+Author:         Bo Smith (bo@bosmith.tech)
+'''
+##############################################################################
+import argparse
+import collections
+import concurrent.futures
+import functools
+import logging
+import re
+import time
+
+import netsnmp
+
+import check_runner
+import snmp_bulk
+
+ok = 0
+warn = 1
+crit = 2
+unknown = 3
+
+# Columns each plugin reads, the poller asks for the union per PDU and table
+columns = {
+    'check_snmp_apcpdu_bank': [
+        "PowerNet-MIB::rPDU2BankStatusModule",
+        "PowerNet-MIB::rPDU2BankStatusNumber",
+        "PowerNet-MIB::rPDU2BankStatusCurrent"],
+    'check_snmp_apcpdu_load': [
+        "PowerNet-MIB::rPDU2DeviceStatusModule",
+        "PowerNet-MIB::rPDU2DeviceStatusPower"],
+    'check_snmp_apcpdu_phase': [
+        "PowerNet-MIB::rPDU2PhaseStatusModule",
+        "PowerNet-MIB::rPDU2PhaseStatusNumber",
+        "PowerNet-MIB::rPDU2PhaseStatusCurrent"],
+    'check_snmp_apcpdu_temp': [
+        "PowerNet-MIB::rPDU2SensorTempHumidityStatusTempF",
+        "PowerNet-MIB::rPDU2SensorTempHumidityStatusTempStatus",
+        "PowerNet-MIB::rPDU2SensorTempHumidityStatusName"],
+    'check_snmp_geist_current': [
+        "GEIST-IMD-MIB::pduPhaseName",
+        "GEIST-IMD-MIB::pduPhaseCurrent"],
+    'check_snmp_geist_voltage': [
+        "GEIST-IMD-MIB::pduPhaseName",
+        "GEIST-IMD-MIB::pduPhaseVoltage"],
+    'check_snmp_geist_wattage': [
+        "GEIST-IMD-MIB::pduPhaseName",
+        "GEIST-IMD-MIB::pduPhaseRealPower"]
+}
+# The table a column belongs to, i.e. rPDU2BankStatus for
+# rPDU2BankStatusCurrent and pduPhase for pduPhaseVoltage
+table_pattern = re.compile(r'::(rPDU2\w+?Status|pduPhase)')
+range_pattern = re.compile(r'(\d+\:\d+)')
+float_range_pattern = re.compile(r'(.+\:.+)')
+
+Service = collections.namedtuple('Service', ['host', 'service', 'plugin', 'opts'])
+
+
+# Get arguments
+##############################################################################
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description='Poll APC/Geist PDUs once per cycle for every PDU service')
+    parser.add_argument(
+        '-f',
+        '--checks',
+        action='store',
+        required=True,
+        help='File with one "HOST;SERVICE;PLUGIN ARGS" per line, # for comments\n'
+        ' i.e. pdu01;Bank Current;check_snmp_apcpdu_bank -H pdu01 -v 2c -C public -w 12 -c 16'
+    )
+    parser.add_argument(
+        '-n',
+        '--concurrency',
+        action='store',
+        default=50,
+        type=int,
+        required=False,
+        help='PDUs to poll at the same time (Default 50)'
+    )
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        action='store',
+        default=5,
+        type=int,
+        required=False,
+        help='Seconds to wait on each SNMP request (Default 5)'
+    )
+    parser.add_argument(
+        '-i',
+        '--interval',
+        action='store',
+        default=0,
+        type=int,
+        required=False,
+        help='Seconds between cycles, 0 runs a single cycle (Default 0)'
+    )
+    parser.add_argument(
+        '--command-file',
+        action='store',
+        required=False,
+        help='Nagios command pipe to submit passive results to\n'
+        ' i.e. /opt/opsview/monitoringscripts/var/rw/nagios.cmd'
+    )
+    parser.add_argument(
+        '--results-file',
+        action='store',
+        required=False,
+        help='Append passive results to this file instead of the command pipe'
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        default=False,
+        required=False,
+        help='Enable debug logging'
+    )
+    args = parser.parse_args()
+    return(args)
+
+
+# The options the PDU plugins take, shared by the APC and Geist families
+##############################################################################
+class PluginArgsError(Exception):
+    pass
+
+
+class PluginParser(argparse.ArgumentParser):
+    # Report a bad service definition rather than exiting the poller
+    def error(self, message):
+        raise PluginArgsError(message)
+
+
+def get_plugin_parser():
+    parser = PluginParser(add_help=False)
+    parser.add_argument('-H', '--host', required=True)
+    parser.add_argument('-v', '--version', required=True)
+    parser.add_argument('-C', '--community', default='')
+    parser.add_argument('-l', '--seclevel', default='authPriv')
+    parser.add_argument('-a', '--authproto', default='')
+    parser.add_argument('-A', '--authkey', default='')
+    parser.add_argument('-x', '--privproto', default='')
+    parser.add_argument('-X', '--privkey', default='')
+    parser.add_argument('-u', '--secuser', default='')
+    parser.add_argument('-w', '--warning', default=None)
+    parser.add_argument('-c', '--critical', default=None)
+    parser.add_argument('-r', '--max-repetitions', type=int,
+                        default=snmp_bulk.max_repetitions)
+    return(parser)
+
+
+plugin_parser = get_plugin_parser()
+
+
+def parse_plugin_args(argv):
+    if argv[0] not in columns:
+        raise PluginArgsError('{} is not a PDU plugin'.format(argv[0]))
+    opts, extra = plugin_parser.parse_known_args(argv[1:])
+    if opts.version == '2c':
+        opts.version = '2'
+    return(opts)
+
+
+# Read the services and group them by PDU and credentials
+##############################################################################
+def get_pdus(path):
+    pdus = collections.OrderedDict()
+    errors = []
+    for check in check_runner.get_checks(path):
+        try:
+            opts = parse_plugin_args(check.argv)
+        except PluginArgsError as err:
+            errors.append((check, str(err)))
+            continue
+        key = (opts.host, opts.version, opts.community, opts.seclevel,
+               opts.authproto.upper(), opts.authkey, opts.privproto.upper(),
+               opts.privkey, opts.secuser)
+        pdus.setdefault(key, []).append(
+            Service(check.host, check.service, check.argv[0], opts))
+    return(pdus, errors)
+
+
+def get_table_name(column):
+    return(table_pattern.search(column).group(1))
+
+
+@functools.lru_cache(maxsize=None)
+def get_tables(plugins):
+    # The same mix of services comes up on PDU after PDU.  Every table is
+    # its own GETBULK, all of them in one request would be more varbinds
+    # than PDU agents will put in a response.
+    tables = collections.OrderedDict()
+    for plugin in sorted(plugins):
+        for column in columns[plugin]:
+            needed = tables.setdefault(get_table_name(column), [])
+            if column not in needed:
+                needed.append(column)
+    return(tables)
+
+
+# One session and one table read per PDU
+##############################################################################
+def setup_session(key, timeout):
+    host, version, community, seclevel, authproto, authkey, privproto, \
+        privkey, secuser = key
+    kwargs = {
+        'DestHost': host,
+        'Timeout': timeout * 1000000,
+        'Retries': 1
+    }
+    if version == '2':
+        if community == '':
+            raise PluginArgsError('Version 2 requires a community string')
+        kwargs.update(Version=2, Community=community)
+    elif version == '3':
+        if '' in (authproto, authkey, privproto, privkey, secuser):
+            raise PluginArgsError('Version 3 requires AuthProto, AuthPass, '
+                                  'PrivProto, PrivPass and SecName')
+        kwargs.update(Version=3, SecLevel=seclevel, AuthProto=authproto,
+                      AuthPass=authkey, PrivProto=privproto, PrivPass=privkey,
+                      SecName=secuser)
+    else:
+        raise PluginArgsError('Unsupported SNMP version '+str(version))
+    return(netsnmp.Session(**kwargs))
+
+
+def poll_pdu(key, services, timeout):
+    start = time.time()
+    try:
+        session = setup_session(key, timeout)
+    except Exception as err:
+        duration = time.time() - start
+        return([check_runner.Result(
+            s.host, s.service, unknown,
+            'UNKNOWN - Unable to poll {} {}'.format(key[0], str(err)),
+            duration) for s in services])
+    tables = get_tables(frozenset(s.plugin for s in services))
+    repetitions = max(s.opts.max_repetitions for s in services)
+    rows = {}
+    errors = {}
+    for table, needed in tables.items():
+        # A table the agent can not read only fails the services using it
+        try:
+            for iid, row in snmp_bulk.get_table(
+                    session, needed, repetitions).items():
+                rows.setdefault(iid, {}).update(row)
+        except Exception as err:
+            errors[table] = err
+    results = []
+    for service in services:
+        failed = [errors[table] for table in
+                  get_tables(frozenset([service.plugin])) if table in errors]
+        if failed:
+            code = unknown
+            output = 'UNKNOWN - Unable to poll {} {}'.format(
+                key[0], str(failed[0]))
+        else:
+            try:
+                code, output = evaluators[service.plugin](rows, service.opts)
+            except Exception as err:
+                code = unknown
+                output = 'UNKNOWN - {} failed {}'.format(
+                    service.plugin, str(err))
+        results.append(check_runner.Result(service.host, service.service,
+                                           code, output, time.time() - start))
+    return(results)
+
+
+# Per plugin evaluation, thresholds and output match the plugins
+##############################################################################
+def get_rows(rows, column):
+    return([(iid, row) for iid, row in rows.items() if column in row])
+
+
+def get_state(critical, warning, found, message, status_string, perf_string):
+    if critical:
+        return(crit, 'CRITICAL:'+status_string+perf_string)
+    elif warning:
+        return(warn, 'WARNING:'+status_string+perf_string)
+    elif not found:
+        return(unknown, message)
+    return(ok, 'OK:'+status_string+perf_string)
+
+
+def get_perf(perf_string, count, item):
+    if count > 0:
+        return(perf_string+' '+item)
+    return(perf_string+item)
+
+
+def evaluate_apc(rows, opts, column, label, scale, to_number):
+    warning_level = to_number(opts.warning) if opts.warning else 0
+    critical_level = to_number(opts.critical) if opts.critical else 0
+    critical = warning = False
+    status_string = ''
+    perf_string = ' | '
+    count = 0
+    prefix = column.rsplit('Status', 1)[0]+'Status'
+    for iid, row in get_rows(rows, column):
+        pdu = row[prefix+'Module']
+        value = to_number(row[column]) * scale
+        if (critical_level > 0) and (value >= critical_level):
+            critical = True
+        if (warning_level > 0) and (value >= warning_level):
+            warning = True
+        name = label(pdu, row)
+        status_string = status_string+' '+name[0]+': '+str(value)+name[1]
+        perf_string = get_perf(perf_string, count, name[0]+'='+str(value))
+        count += 1
+    return(get_state(critical, warning, count, 'UNKNOWN: Unable to get current',
+                     status_string, perf_string))
+
+
+def evaluate_apcpdu_bank(rows, opts):
+    return(evaluate_apc(
+        rows, opts, 'rPDU2BankStatusCurrent',
+        lambda pdu, row: ('pdu'+pdu+'_bank'+row['rPDU2BankStatusNumber'], ''),
+        .1, int))
+
+
+def evaluate_apcpdu_load(rows, opts):
+    return(evaluate_apc(
+        rows, opts, 'rPDU2DeviceStatusPower',
+        lambda pdu, row: ('pdu'+pdu+'_power', ' kW'),
+        .01, float))
+
+
+def evaluate_apcpdu_phase(rows, opts):
+    return(evaluate_apc(
+        rows, opts, 'rPDU2PhaseStatusCurrent',
+        lambda pdu, row: ('pdu'+pdu+'_phase_l'+row['rPDU2PhaseStatusNumber'], ''),
+        .1, int))
+
+
+def evaluate_apcpdu_temp(rows, opts):
+    temp = {}
+    for iid, row in get_rows(rows, 'rPDU2SensorTempHumidityStatusTempF'):
+        # Status 4 means the sensor is installed
+        if row.get('rPDU2SensorTempHumidityStatusTempStatus') == '4':
+            name = row.get('rPDU2SensorTempHumidityStatusName', iid)
+            temp[name] = str(int(row['rPDU2SensorTempHumidityStatusTempF']) * .1)
+    critical = warning = False
+    status_string = ''
+    perf_string = ' | '
+    count = 0
+    for sensor, t in temp.items():
+        tf = int(t.split('.')[0])
+        for level, threshold in ((crit, opts.critical), (warn, opts.warning)):
+            if not threshold:
+                continue
+            if range_pattern.search(threshold):
+                low, high = [int(x) for x in threshold.split(':')[:2]]
+                hit = (tf <= low) or (tf >= high)
+            else:
+                hit = (int(threshold) > 0) and (tf >= int(threshold))
+            if hit and level == crit:
+                critical = True
+            elif hit:
+                warning = True
+        status_string = status_string+' '+sensor+': '+t
+        perf_string = get_perf(perf_string, count, sensor+'='+t)
+        count += 1
+    return(get_state(critical, warning, count,
+                     'UNKNOWN: Unable to get temperature',
+                     status_string, perf_string))
+
+
+def evaluate_geist(rows, opts, column, label, perf, scale, ranges):
+    critical = warning = False
+    status_string = ''
+    perf_string = ' | '
+    count = 0
+    for iid, row in get_rows(rows, column):
+        name = row.get('pduPhaseName', '').replace(' ', '_')
+        value = float(row[column]) * scale
+        # Critical is checked first and a warning only when no critical
+        # threshold was given, as the plugins do
+        if opts.critical:
+            level, threshold = crit, opts.critical
+        elif opts.warning:
+            level, threshold = warn, opts.warning
+        else:
+            level, threshold = None, None
+        hit = False
+        if threshold and ranges and float_range_pattern.search(threshold):
+            low, high = [float(x) for x in threshold.split(':')[:2]]
+            hit = (value > 0) and ((value <= low) or (value >= high))
+        elif threshold:
+            hit = (value > 0) and (value >= float(threshold))
+        if hit and level == crit:
+            critical = True
+        elif hit:
+            warning = True
+        status_string = status_string+' '+name+label+str(value)
+        perf_string = get_perf(perf_string, count, name+perf+'='+str(value))
+        count += 1
+    return(get_state(critical, warning, count,
+                     'UNKNOWN: Unable to get '+perf.strip('_'),
+                     status_string, perf_string.lower()))
+
+
+def evaluate_geist_current(rows, opts):
+    return(evaluate_geist(rows, opts, 'pduPhaseCurrent', ' Current:',
+                          '_current', .01, False))
+
+
+def evaluate_geist_voltage(rows, opts):
+    return(evaluate_geist(rows, opts, 'pduPhaseVoltage', ' Voltage:',
+                          '_voltage', .1, True))
+
+
+def evaluate_geist_wattage(rows, opts):
+    return(evaluate_geist(rows, opts, 'pduPhaseRealPower', ' Watts :',
+                          '_watts', 1, False))
+
+
+evaluators = {
+    'check_snmp_apcpdu_bank': evaluate_apcpdu_bank,
+    'check_snmp_apcpdu_load': evaluate_apcpdu_load,
+    'check_snmp_apcpdu_phase': evaluate_apcpdu_phase,
+    'check_snmp_apcpdu_temp': evaluate_apcpdu_temp,
+    'check_snmp_geist_current': evaluate_geist_current,
+    'check_snmp_geist_voltage': evaluate_geist_voltage,
+    'check_snmp_geist_wattage': evaluate_geist_wattage
+}
+
+
+# Poll every PDU once
+##############################################################################
+def run_cycle(pool, pdus, timeout):
+    futures = [pool.submit(poll_pdu, key, services, timeout)
+               for key, services in pdus.items()]
+    results = []
+    for future in concurrent.futures.as_completed(futures):
+        results.extend(future.result())
+    return(results)
+
+
+# Git-r-done!
+##############################################################################
+def main():
+    args = get_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    pdus, errors = get_pdus(args.checks)
+    for check, error in errors:
+        logging.error('Skipping %s;%s %s', check.host, check.service, error)
+    logging.info('Polling %s services on %s PDUs',
+                 sum(len(s) for s in pdus.values()), len(pdus))
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency)
+    try:
+        while True:
+            start = time.time()
+            results = run_cycle(pool, pdus, args.timeout)
+            check_runner.submit_results(args, results)
+            counts = collections.Counter(
+                check_runner.states[r.code] for r in results)
+            logging.info('Polled %s PDUs in %.1f seconds %s', len(pdus),
+                         time.time() - start, dict(counts))
+            if not args.interval:
+                break
+            time.sleep(max(0, args.interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    main()
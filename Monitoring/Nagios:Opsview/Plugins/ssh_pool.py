@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+##############################################################################
+'''
+Description:    Local SSH connection pool shared by the check_ssh_* plugins.
+                Run it as a daemon on the Opsview collector and it keeps
+                authenticated paramiko transports open per host/user/key,
+                opening a new channel for each check.  Plugins reach it
+                over a Unix socket through connect() and fall back to a
+                direct connection when the daemon is not running.
+Requirements:   paramiko
+Created:        2026-10-18
+Author:         Bo Smith (bo@bosmith.tech)
+'''
+##############################################################################
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+import paramiko
+
+# Socket can be moved with the SSH_POOL_SOCKET environment variable so the
+# plugins and the daemon agree without adding a new plugin argument.  It
+# carries passwords and keys, so it lives in a directory only the service
+# user can write to rather than somewhere like /tmp.
+default_socket = os.environ.get('SSH_POOL_SOCKET',
+                                '/var/run/opsview/ssh_pool.sock')
+# Seconds to wait for the local daemon before falling back to direct connect
+socket_timeout = 2
+
+
+# Get arguments
+##############################################################################
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='SSH connection pool daemon for the check_ssh_* plugins')
+    parser.add_argument(
+        '-S',
+        '--socket',
+        action='store',
+        default=default_socket,
+        required=False,
+        help='Path of the Unix socket to listen on (Default {})'.format(
+            default_socket)
+    )
+    parser.add_argument(
+        '-i',
+        '--idle',
+        action='store',
+        default=300,
+        type=int,
+        required=False,
+        help='Seconds a connection may sit idle before it is closed (Default 300)'
+    )
+    parser.add_argument(
+        '-m',
+        '--max-sessions',
+        action='store',
+        default=8,
+        type=int,
+        required=False,
+        help='Concurrent channels per connection, keep below the sshd '
+             'MaxSessions setting (Default 8)'
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        action='store_true',
+        default=False,
+        required=False,
+        help='Enable debug logging'
+    )
+    args = parser.parse_args()
+    return(args)
+
+
+# Plugin side
+##############################################################################
+class PoolError(Exception):
+    pass
+
+
+class PooledChannel(object):
+    '''Stands in for paramiko's Channel so recv_exit_status() still works'''
+
+    def __init__(self, status):
+        self.status = status
+
+    def recv_exit_status(self):
+        return(self.status)
+
+
+class PooledFile(io.StringIO):
+    '''Stands in for the stdout/stderr files paramiko hands back'''
+
+    def __init__(self, data, status):
+        io.StringIO.__init__(self, data)
+        self.channel = PooledChannel(status)
+
+
+class PooledClient(object):
+    '''Minimal SSHClient look-alike that runs commands through the daemon'''
+
+    def __init__(self, path, conn):
+        self.path = path
+        self.conn = conn
+
+    def request(self, op, timeout=None, **kwargs):
+        payload = {'op': op, 'conn': self.conn, 'timeout': timeout}
+        payload.update(kwargs)
+        return(send_request(self.path, payload,
+                            max(self.conn['timeout'], timeout or 0)))
+
+    def exec_command(self, cmd, get_pty=False, timeout=None):
+        # The daemon applies the timeout to the channel as paramiko would
+        response = self.request('exec', cmd=cmd, get_pty=get_pty,
+                                timeout=timeout)
+        stdin = io.StringIO()
+        stdout = PooledFile(response['stdout'], response['status'])
+        stderr = PooledFile(response['stderr'], response['status'])
+        return(stdin, stdout, stderr)
+
+    def close(self):
+        # The daemon owns the transport, nothing to tear down here
+        pass
+
+
+def send_request(path, payload, timeout):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Leave the daemon some headroom to apply the ssh timeout on its own
+    sock.settimeout(timeout * 2 + socket_timeout)
+    try:
+        sock.connect(path)
+        sock.sendall(json.dumps(payload).encode() + b'\n')
+        data = sock.makefile('rb').readline()
+        response = json.loads(data)
+    except (OSError, ValueError) as err:
+        raise PoolError('SSH pool unavailable '+str(err))
+    finally:
+        sock.close()
+    if response['ok']:
+        return(response)
+    # Re-raise with the exception types the plugins already handle
+    if response['kind'] == 'auth':
+        raise paramiko.AuthenticationException(response['error'])
+    elif response['kind'] == 'ssh':
+        raise paramiko.SSHException(response['error'])
+    elif response['kind'] == 'io':
+        raise IOError(response['error'])
+    raise PoolError(response['error'])
+
+
+def is_trusted(path):
+    # Only hand credentials to a socket our own user created owner-only, a
+    # socket planted by anyone else could be collecting them
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return(False)
+    return(stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and
+           stat.S_IMODE(st.st_mode) == 0o600)
+
+
+def connect(args, path=None):
+    '''
+    Return a PooledClient for the plugin arguments, or None when the daemon
+    is not running, or its socket is not one the service user owns, so the
+    caller can fall back to a direct connection.  Authentication errors
+    reported by the daemon are raised as the usual paramiko exceptions.
+    '''
+    path = path or default_socket
+    if not is_trusted(path):
+        return(None)
+    conn = {
+        'host': args.host,
+        'port': getattr(args, 'port', 22),
+        'username': getattr(args, 'username', ''),
+        'password': getattr(args, 'password', ''),
+        'sshkey': getattr(args, 'sshkey', ''),
+        'sshkeystring': getattr(args, 'sshkeystring', ''),
+        'timeout': getattr(args, 'timeout', 15)
+    }
+    client = PooledClient(path, conn)
+    try:
+        client.request('connect')
+    except PoolError:
+        # Daemon is down or wedged, connect directly instead
+        return(None)
+    return(client)
+
+
+# Daemon side
+##############################################################################
+class PooledConnection(object):
+
+    def __init__(self, client, max_sessions):
+        self.client = client
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.last_used = time.time()
+        self.busy = 0
+
+    def is_active(self):
+        transport = self.client.get_transport()
+        return(transport is not None and transport.is_active())
+
+    def close(self):
+        self.client.close()
+
+
+class SSHPool(object):
+
+    def __init__(self, idle, max_sessions):
+        self.idle = idle
+        self.max_sessions = max_sessions
+        self.connections = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, conn):
+        # Secrets are hashed into the key so a wrong password or key can
+        # never ride on a transport someone else authenticated
+        secret = hashlib.sha256()
+        secret.update(conn['password'].encode())
+        secret.update(b'\0')
+        secret.update(conn['sshkeystring'].encode())
+        return((conn['host'], int(conn['port']), conn['username'],
+                conn['sshkey'], secret.hexdigest()))
+
+    def open_client(self, conn):
+        # Same connection setup as setup_ssh() in the plugins
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        clientargs = {
+            'banner_timeout': conn['timeout'],
+            'timeout': conn['timeout'],
+            'password': conn['password'],
+            'port': int(conn['port']),
+            'username': conn['username']
+        }
+        if conn['sshkey']:
+            clientargs['key_filename'] = conn['sshkey']
+        elif conn['sshkeystring']:
+            s = io.StringIO(conn['sshkeystring'].replace('\\n', '\n'))
+            clientargs['pkey'] = paramiko.RSAKey.from_private_key(
+                s,
+                password=conn['password']
+            )
+        client.connect(conn['host'], **clientargs)
+        # Keep NAT and firewalls from dropping the idle transport
+        client.get_transport().set_keepalive(30)
+        return(client)
+
+    def acquire(self, conn):
+        key = self.get_key(conn)
+        with self.lock:
+            keylock = self.locks.setdefault(key, threading.Lock())
+        # Only one thread per key connects, the rest wait and reuse it
+        with keylock:
+            with self.lock:
+                pooled = self.connections.get(key)
+                if pooled is not None and pooled.is_active():
+                    pooled.busy += 1
+                    pooled.last_used = time.time()
+                    return(pooled)
+            if pooled is not None:
+                logging.debug('Reconnecting dropped transport to %s',
+                              conn['host'])
+                pooled.close()
+            logging.debug('Opening transport to %s@%s',
+                          conn['username'], conn['host'])
+            pooled = PooledConnection(self.open_client(conn),
+                                      self.max_sessions)
+            with self.lock:
+                self.connections[key] = pooled
+                pooled.busy += 1
+        return(pooled)
+
+    def release(self, pooled):
+        with self.lock:
+            pooled.busy -= 1
+            pooled.last_used = time.time()
+
+    def run(self, conn, cmd, get_pty, timeout=None):
+        pooled = self.acquire(conn)
+        try:
+            with pooled.sessions:
+                chan = pooled.client.get_transport().open_session(
+                    timeout=conn['timeout'])
+                try:
+                    chan.settimeout(timeout or conn['timeout'])
+                    if get_pty:
+                        chan.get_pty()
+                    chan.exec_command(cmd)
+                    stdout = chan.makefile('rb').read()
+                    stderr = chan.makefile_stderr('rb').read()
+                    status = chan.recv_exit_status()
+                finally:
+                    chan.close()
+        finally:
+            self.release(pooled)
+        return({
+            'ok': True,
+            'stdout': stdout.decode(errors='replace'),
+            'stderr': stderr.decode(errors='replace'),
+            'status': status
+        })
+
+    def evict(self):
+        now = time.time()
+        with self.lock:
+            for key, pooled in list(self.connections.items()):
+                if pooled.busy:
+                    continue
+                if (now - pooled.last_used) > self.idle or not pooled.is_active():
+                    logging.debug('Evicting idle transport to %s', key[0])
+                    del self.connections[key]
+                    pooled.close()
+
+    def reaper(self):
+        while True:
+            time.sleep(max(1, min(30, self.idle)))
+            self.evict()
+
+
+class PoolHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            conn = request['conn']
+            if request['op'] == 'connect':
+                pooled = self.server.pool.acquire(conn)
+                self.server.pool.release(pooled)
+                response = {'ok': True}
+            elif request['op'] == 'exec':
+                response = self.server.pool.run(conn, request['cmd'],
+                                                request.get('get_pty', False),
+                                                request.get('timeout'))
+            else:
+                response = {'ok': False, 'kind': 'error',
+                            'error': 'Unknown op '+str(request['op'])}
+        except paramiko.AuthenticationException as err:
+            response = {'ok': False, 'kind': 'auth', 'error': str(err)}
+        except paramiko.SSHException as err:
+            response = {'ok': False, 'kind': 'ssh', 'error': str(err)}
+        except IOError as err:
+            response = {'ok': False, 'kind': 'io', 'error': str(err)}
+        except Exception as err:
+            response = {'ok': False, 'kind': 'error', 'error': str(err)}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class PoolServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# Git-r-done!
+##############################################################################
+def main():
+    args = get_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s %(levelname)s %(message)s')
+    # The plugins only trust a socket in a directory of ours
+    try:
+        os.makedirs(os.path.dirname(args.socket), mode=0o700, exist_ok=True)
+    except OSError as err:
+        logging.error('Unable to create %s %s',
+                      os.path.dirname(args.socket), str(err))
+        sys.exit(1)
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    # The socket hands out authenticated sessions, keep it owner-only
+    old_umask = os.umask(0o177)
+    try:
+        server = PoolServer(args.socket, PoolHandler)
+    finally:
+        os.umask(old_umask)
+    server.pool = SSHPool(args.idle, args.max_sessions)
+    threading.Thread(target=server.pool.reaper, daemon=True).start()
+    logging.info('SSH pool listening on %s', args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        for pooled in server.pool.connections.values():
+            pooled.close()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,7 +14,7 @@ Created:        2024-06-13
 Author:         Bo Smith (bo@bosmith.tech)
 Requirements:   
                 - python requests module
-                - python pygithub module
+                - git, when the catalogue comes from a repository
                 - Datadog organization
                 - Datadog api key
                 - Datadog app key
@@ -22,112 +22,36 @@ Requirements:
 """
 
 import argparse
+import concurrent.futures
 import csv
-import github
+import hashlib
 import logging
 import json
+import os
 import requests
 import pprint
+import re
+import subprocess
 import sys
+import threading
+import time
 
 
-################################################################################
-# PESA Supported Integrations
-################################################################################
-# TODO Read this data from github 
-pesa_supported = [
-    "aws.apigateway.5xx",
-    "aws.apigateway.latency",
-    "aws.applicationelb.healthy_host_count",
-    "aws.dynamodb.successful_request_latency",
-    "aws.dynamodb.system_errors",
-    "aws.dx",
-    "aws.elb",
-    "aws.lambda.throttles",
-    "aws.networkelb.healthy_host_count",
-    "aws.rds.database_connections",
-    "aws.rds.cpuutilization",
-    "aws.rds.free_storage_space",
-    "aws.vpn.tunnel_state",
-    "azure.dbforpostgresql_servergroupsv2.cpu_percent",
-    "azure.network_virtualnetworkgateways.bgp_peer_status",
-    # "azure.containerservice_managedclusters.status",
-    # "azure.containerservice_managedclusters.node_memory_rss_percentage",
-    # "azure.containerservice_managedclusters.node_memory_working_set_percentage",
-    # "azure.containerservice_managedclusters.node_disk_usage_percentage",
-    # "azure.containerservice_managedclusters.kube_node_status_condition",
-    # "azure.containerservice_managedclusters.kube_pod_status_phase",
-    "azure.datafactory_factories.pipeline_failed_runs",
-    "azure.functions.http4xx",
-    "azure.functions.http5xx",
-    "azure.logic_workflows.runs_failed",
-    "azure.netapp_netappaccounts_capacitypools_volumes.volume_logical_size",
-    "azure.network_applicationgateways.healthy_host_count",
-    "azure.network_applicationgateways.response_status",
-    "azure.network_loadbalancers.backend_pool_host_count",
-    "azure.network_loadbalancers.health_probe_status",
-    "azure.network_loadbalancers.status",
-    "azure.recoveryservices_vaults.backup_health_event",
-    "gcp.router.bgp.session_up",
-    "gcp.file.nfs.server.used_bytes_percent",
-    "gcp.interconnect.network.attachment.received_packets_count",
-    "gcp.loadbalancing.https.backend_latencies",
-    "gcp.loadbalancing.https.backend_request_bytes_count",
-    "gcp.loadbalancing.https.backend_response_bytes_count",
-    "gcp.loadbalancing.https.backend_request_count",
-    "gcp.loadbalancing.https.total_latencies.p99",
-    "gcp.loadbalancing.https.request_bytes_count",
-    "gcp.loadbalancing.https.response_bytes_count",
-    "gcp.loadbalancing.https.request_count",
-    "custom_check.gcp_ilb_healthy_hosts.healthy_percentage",
-    "custom_check.gcp_compute_snapshot.failed_snapshots",
-    "custom_check.gcp_compute_snapshot.missing_snapshots",
-    "custom_check.gcp_compute_snapshot.no_existing_snapshots",
-    "custom_check.gcp_compute_snapshot.snapshot_zone_ops_errors",
-    "custom_check.gcp_compute_snapshot.snapshot_zone_ops_warnings",
-    "gcp.spanner.instance.cpu.utilization",
-    "gcp.spanner.query_stat.total.failed_execution_count",
-    "gcp.spanner.api.request_latencies.avg",
-    "gcp.spanner.api.request_latencies.avg",
-    "gcp.vpn.tunnel_established",
-    "iis.app_pool_up",
-    "kubernetes.containers.restarts",
-    "kubernetes_state.deployment.replicas_desired",
-    "kubernetes_state.node.disk_pressure",
-    "kubernetes_state.pod.status_phase",
-    "kubernetes_state.statefulset.replicas_desired",
-    "kubernetes_state.node.memory_pressure",
-    "kubernetes_state.node.status",
-    "kubernetes_state.container.status_report.count.waiting",
-    "kubernetes_state.pod.unschedulable",
-    "sftp.can_connect",
-    "ssh.can_connect",
-    "w3svc",
-    "nagios",
-    "network.ping.can_connect",
-    "network.http.response_time",
-    "rabbitmq.aliveness",
-    "rabbitmq.node.disk_alarm",
-    "rabbitmq.node.mem_alarm",
-    "rabbitmq.status",
-    "snmp.can_check",
-    "snmp.ifOperStatus",
-    "snmp.ifHCInOctets.rate",
-    "synthetics.http.response.time",
-    "http.ssl_cert",
-    "http.ssl.days_left",
-    "tcp.can_connect",
-    "system.cpu",
-    "system.disk",
-    "kafka.consumer_lag_seconds",
-    "system.mem",
-    "system.uptime",
-    "vsphere.disk",
-    "vsphere.disk.provisioned.latest",
-    "vsphere.disk.used.latest",
-    "vsphere.disk.maxTotalLatency.latest",
-    "vsphere.sys.uptime.latest"
-]
+# Catalogue of PESA supported integrations shipped next to the script
+supported_file = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "pesa_supported.txt")
+# Metric names as they appear in monitor queries, i.e. avg:aws.elb.latency{*}
+metric_pattern = re.compile(r"[A-Za-z0-9_.]+")
+# Datadog caps /api/v1/monitor pages at 1000
+monitor_page_size = 1000
+metric_page_size = 10000
+process_page_size = 1000
+# Attempts at a throttled or failing call before giving up
+max_retries = 5
+# Cache entries older than this are fetched in full rather than topped up
+cache_full_ttl = 86400
+# Columns of the --format csv/jsonl findings
+finding_fields = ["org", "host", "integration", "finding"]
 
 
 
@@ -146,20 +70,59 @@ def get_args():
     )
     parser.add_argument(
         '--apikey',
-        required=True,
-        help="Datadog API key (Required)"
+        required=False,
+        help="Datadog API key (Required unless --orgs is used)"
     )
     parser.add_argument(
         '--appkey',
-        required=True,
-        help="Datadog API key (Required)"
+        required=False,
+        help="Datadog APP key (Required unless --orgs is used)"
+    )
+    parser.add_argument(
+        '--orgs',
+        default=None,
+        required=False,
+        help="JSON file with a list of orgs to audit concurrently, each with name, apikey, appkey and optionally url"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        required=False,
+        help="Orgs to audit at the same time (Optional Default: 4)"
+    )
+    parser.add_argument(
+        '--format',
+        choices=["log", "jsonl", "csv"],
+        default="log",
+        required=False,
+        help="Write findings as log warnings, JSON lines or CSV (Optional Default: log)"
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        default="-",
+        required=False,
+        help="File to write jsonl/csv findings to (Optional Default: stdout)"
     )
     parser.add_argument(
         '-g',
         '--github',
         default=None,
         required=False,
-        help="GitHub API Token (Optional Default is unauthenticated. Use a token when hitting rate limits)"
+        help="GitHub Token used to clone --supported-repo (Optional Default is unauthenticated)"
+    )
+    parser.add_argument(
+        '--supported',
+        default=None,
+        required=False,
+        help="Supported integrations catalogue, one per line. Relative to the checkout with --supported-repo (Optional Default: pesa_supported.txt next to this script, or in the checkout)"
+    )
+    parser.add_argument(
+        '--supported-repo',
+        default=None,
+        required=False,
+        help="Git repository holding the catalogue, cloned or pulled into --cache-dir (Optional)"
     )
     parser.add_argument(
         '-u',
@@ -168,13 +131,41 @@ def get_args():
         required=False,
         help="Datadog URL (optional Default: app.datadoghq.com)"
     )
+    parser.add_argument(
+        '--cache-ttl',
+        type=int,
+        default=0,
+        required=False,
+        help="Seconds to reuse cached metrics, monitors and processes for this org (Optional Default: 0, no cache)"
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default="/var/tmp/dd_integrations_cache",
+        required=False,
+        help="Directory for the per org cache (optional Default: /var/tmp/dd_integrations_cache)"
+    )
+    parser.add_argument(
+        '--offline',
+        action="store_true",
+        default=False,
+        help="Run the gap analysis from the cache only, without calling Datadog"
+    )
     parser.add_argument(
         '--debug',
         action="store_true",
         default=False,
         help="Set loglevel to DEBUG"
     )
-    return(parser.parse_args())
+    args = parser.parse_args()
+    if not args.orgs and not (args.apikey and args.appkey):
+        parser.error("--apikey and --appkey are required unless --orgs is used")
+    if args.supported_repo:
+        args.supported = args.supported or os.path.basename(supported_file)
+        if os.path.isabs(args.supported):
+            parser.error("--supported must be relative to the checkout with --supported-repo")
+    elif not args.supported:
+        args.supported = supported_file
+    return(args)
 
 
 def setup_session(args):
@@ -205,56 +196,276 @@ def get_integrations(args, session):
 
     Returns
     =======
-        integrations    '(list)' List of unique source.integrations
+        integrations    '(set)' Set of unique source.integrations
     """
-    integrations = []
+    integrations = set()
 
     logging.info("Getting integrations")
-    try:
-        i = session.get(
-            f"{args.url}/api/v2/metrics"
-        )
-        i.raise_for_status()
-        metrics = i.json()['data']
-    except requests.exceptions.HTTPError as err:
-        logging.error(str(err))
-        sys.exit(1)
-    
-    # Filter metrics by their integration
-    for metric in metrics:
-        # Split metric into source, target and ignore the rest
-        source, target, *_ = metric['id'].split('.', 2)
-        integration = f"{source}.{target}"
-        if integration not in integrations:
-            integrations.append(integration)
+    # Orgs with a large catalogue get it back in cursor pages
+    params = {"page[size]": metric_page_size}
+    while True:
+        try:
+            i = get_with_backoff(session, f"{args.url}/api/v2/metrics", params)
+            response = i.json()
+        except requests.exceptions.HTTPError as err:
+            logging.error(str(err))
+            sys.exit(1)
+
+        # Filter metrics by their integration
+        for metric in response['data']:
+            integrations.add(get_integration(metric['id']))
+
+        cursor = response.get('meta', {}).get('pagination', {}).get('next_cursor')
+        if not cursor:
+            break
+        params["page[cursor]"] = cursor
 
     logging.debug("Current Detected Integrations")
     logging.debug(pprint.pformat(integrations))
     return(integrations)
 
 
-def get_monitors(args, session):
+def get_integration(metric):
+    """
+    Split metric into source, target and ignore the rest
+
+    Returns
+    =======
+        integration '(str)' source.target
+    """
+    source, target, *_ = metric.split('.', 2) + ['']
+    return(f"{source}.{target}")
+
+
+def get_monitors(args, session, id_offset=None):
     """
     Function to retrieve currently implemented monitors to use as 
     a source to determine missing monitors compared to implemented
     integrations
 
+    Only monitors with an id above id_offset are returned when it is set,
+    which is how a cached list picks up the monitors created since.
+
     Returns
     =======
         list    List of monitor dictionaries
     """
     logging.info("Getting monitors")
+    monitors = []
+    page = 0
+    params = {"page_size": monitor_page_size}
+    if id_offset is not None:
+        params["id_offset"] = id_offset
+    while True:
+        try:
+            m = get_with_backoff(
+                session,
+                f"{args.url}/api/v1/monitor",
+                dict(params, page=page)
+            )
+        except requests.exceptions.HTTPError as err:
+            logging.error(str(err))
+            sys.exit(1)
+        batch = m.json()
+        monitors.extend(batch)
+        # A short page is the last one
+        if len(batch) < monitor_page_size:
+            break
+        page += 1
+    logging.debug("Current Monitors")
+    logging.debug(pprint.pformat(monitors))
+    return(monitors)
+
+
+def build_prefix_index(words):
+    """
+    Build a character trie from the words so that "does any word start
+    with this" costs one step per character of the prefix, no matter how
+    many words went in
+
+    Returns
+    =======
+        index   '(dict)' Nested dict per character
+    """
+    index = {}
+    for word in words:
+        node = index
+        for char in word:
+            node = node.setdefault(char, {})
+    return(index)
+
+
+def has_prefix(index, prefix):
+    """
+    Check a prefix against an index from build_prefix_index()
+
+    Returns
+    =======
+        bool    True if any indexed word starts with the prefix
+    """
+    node = index
+    for char in prefix:
+        node = node.get(char)
+        if node is None:
+            return(False)
+    return(True)
+
+
+def get_supported_checkout(args):
+    """
+    Clone or fast-forward the catalogue repository into the cache directory
+
+    Returns
+    =======
+        path    '(str)' Path of the catalogue inside the checkout
+    """
+    repo = hashlib.sha256(args.supported_repo.encode()).hexdigest()[:16]
+    checkout = os.path.join(args.cache_dir, "repos", repo)
+    git = ["git"]
+    env = dict(os.environ)
+    if args.github:
+        # Sent as a header so the token never ends up in the checkout's
+        # remote url, and through the environment so it is not on the
+        # command line for ps to show
+        env.update({
+            "GIT_CONFIG_COUNT": "1",
+            "GIT_CONFIG_KEY_0": "http.extraHeader",
+            "GIT_CONFIG_VALUE_0": f"Authorization: Bearer {args.github}"
+        })
+    if os.path.isdir(os.path.join(checkout, ".git")):
+        command = git + ["-C", checkout, "pull", "--quiet", "--ff-only"]
+    else:
+        os.makedirs(os.path.dirname(checkout), mode=0o700, exist_ok=True)
+        command = git + ["clone", "--quiet", "--depth", "1",
+                         args.supported_repo, checkout]
     try:
-        m = session.get(
-            f"{args.url}/api/v1/monitor"
-        )
-        m.raise_for_status()
-        logging.debug("Current Monitors")
-        logging.debug(pprint.pformat(m.json()))
-        return(m.json())
-    except requests.exceptions.HTTPError as err:
-        logging.error(str(err))
+        subprocess.run(command, check=True, capture_output=True, timeout=120,
+                       env=env)
+    except (OSError, subprocess.SubprocessError) as err:
+        # An older checkout is still better than no catalogue at all
+        if not os.path.isdir(os.path.join(checkout, ".git")):
+            logging.error(f"Unable to clone {args.supported_repo} {err}")
+            sys.exit(1)
+        logging.warning(f"Unable to update {args.supported_repo}, using the existing checkout {err}")
+    return(os.path.join(checkout, args.supported))
+
+
+def get_supported_index(args):
+    """
+    Load the supported integrations catalogue as a prefix index.  The
+    compiled index is cached by the catalogue's content hash so an
+    unchanged catalogue is only compiled once.
+
+    Returns
+    =======
+        index   '(dict)' Prefix index of the supported metrics
+    """
+    path = args.supported
+    if args.supported_repo:
+        path = get_supported_checkout(args)
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except IOError as err:
+        logging.error(f"Unable to read supported catalogue {path} {err}")
         sys.exit(1)
+    digest = hashlib.sha256(content).hexdigest()
+    cached = os.path.join(args.cache_dir, "supported", f"{digest}.json")
+    try:
+        with open(cached) as f:
+            return(json.load(f))
+    except (IOError, ValueError):
+        pass
+    supported = []
+    for line in content.decode().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            supported.append(line)
+    logging.info(f"Loaded {len(supported)} supported integrations from {path}")
+    index = build_prefix_index(supported)
+    try:
+        os.makedirs(os.path.dirname(cached), mode=0o700, exist_ok=True)
+        with open(cached + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(cached + ".tmp", cached)
+    except (IOError, OSError) as err:
+        logging.warning(f"Unable to cache supported catalogue {err}")
+    return(index)
+
+
+def get_monitor_index(monitors):
+    """
+    Tokenize every monitor query into the metric names it uses, once, and
+    index them by prefix so an integration can be looked up directly rather
+    than searched for in every query
+
+    Returns
+    =======
+        index   '(dict)' Prefix index of metric names used by monitors
+    """
+    tokens = set()
+    for monitor in monitors:
+        tokens.update(metric_pattern.findall(monitor.get('query', '')))
+    return(build_prefix_index(tokens))
+
+
+def get_with_backoff(session, url, params=None):
+    """
+    GET a Datadog endpoint, honoring its rate limit headers.  A 429 waits
+    out X-RateLimit-Reset and a 5xx backs off exponentially before trying
+    again, and when a call leaves no requests in the current period the
+    next one waits for the reset instead of being rejected.
+
+    Returns
+    =======
+        response    '(object)' requests.Response object
+    """
+    for attempt in range(max_retries + 1):
+        r = session.get(url, params=params)
+        reset = r.headers.get("X-RateLimit-Reset")
+        if r.status_code == 429 or r.status_code >= 500:
+            if attempt < max_retries:
+                wait = float(reset) if r.status_code == 429 and reset else 2 ** attempt
+                logging.info(f"{url} returned {r.status_code}, retrying in {wait}s")
+                time.sleep(wait)
+                continue
+        r.raise_for_status()
+        remaining = r.headers.get("X-RateLimit-Remaining")
+        if remaining is not None and reset and int(remaining) < 1:
+            logging.info(f"Rate limit reached, waiting {reset}s")
+            time.sleep(float(reset))
+        return(r)
+
+
+def iter_processes(args, session):
+    """
+    Walk the /api/v2/processes cursor and yield each process.  Every page is
+    parsed once, and the next page is already being fetched while the
+    caller works through the current one, so only about two pages are
+    ever held in memory.
+
+    Returns
+    =======
+        generator   Process dictionaries
+    """
+    url = f"{args.url}/api/v2/processes"
+    params = {"page[limit]": process_page_size}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(get_with_backoff, session, url, dict(params))
+        while future is not None:
+            try:
+                page = future.result().json()
+            except requests.exceptions.HTTPError as err:
+                logging.error(str(err))
+                sys.exit(1)
+            cursor = page['meta']['page'].get('after')
+            size = page['meta']['page']['size']
+            future = None
+            # A short page is the last one
+            if int(size) >= process_page_size and cursor:
+                params["page[cursor]"] = cursor
+                future = pool.submit(get_with_backoff, session, url, dict(params))
+            yield from page['data']
 
 
 def get_processes(args, session):
@@ -265,57 +476,307 @@ def get_processes(args, session):
 
     Note that this is a hefty function as it aks Datadog for all processes
     it has observed over the last 15m from all systems and is returned
-    in multiple pages.
+    in multiple pages.  Pages are streamed through iter_processes() and
+    folded straight into the per host sets.
+
+    Returns
+    =======
+        processes   '(dict)' Set of integrations per host
     """
     logging.info("Getting processes")
     processes = {}
-    raw_processes = []
-
-    # Get all processes collected by Datadog over the last 15 minutes
-    more = True
-    cursor = ""
-    limit=1000
-    while more == True:
-        if cursor == "":
-            url = f"{args.url}/api/v2/processes?page[limit]={limit}"
-        else:
-            url = f"{args.url}/api/v2/processes?page[limit]=1000&page[cursor]={cursor}"
-        try:
-            p = session.get(
-                f"{url}"
-            )
-            p.raise_for_status()
-            raw_processes.extend(p.json()['data'])
-            cursor = p.json()['meta']['page']['after']
-            size = p.json()['meta']['page']['size']
-            if int(size) < limit:
-                more = False
-            else:
-                more = True
-        except requests.exceptions.HTTPError as err:
-            logging.error(str(err))
-            sys.exit(1)
 
     # Process the ... processes ... yeah
-    # for process in p.json()['data']:
-    for process in raw_processes:
-        pcs = process.get('attributes', None)
+    for process in iter_processes(args, session):
+        pcs = process.get('attributes', {})
         host = pcs.get('host', None)
         # Group our discovered integrations by host so check for a host entry
-        if host not in processes.keys():
-            processes[host] = []
+        integrations = processes.setdefault(host, set())
         # Use the integration tag to identify discovered integrations
-        for tag in process['attributes']['tags']:
-            if "integration" in tag:
-                pcs = next((i for i in pcs.get('tags') if "integration" in i), None)
-                pcs = pcs.split(':')[1].lower()
-                if pcs not in processes.get(host, None):
-                    processes[host].append(pcs)
+        for tag in pcs.get('tags', []):
+            if "integration" in tag and ':' in tag:
+                integrations.add(tag.split(':')[1].lower())
     logging.debug("Detected Processes")
     logging.debug(pprint.pformat(processes))
     return(processes)
 
 
+def get_cache_path(args, endpoint):
+    """
+    Cache files live in a directory per org, named from a hash of the URL
+    and API key so the key itself is never written to disk
+
+    Returns
+    =======
+        path    '(str)' Path of the cache file for the endpoint
+    """
+    org = hashlib.sha256(f"{args.url} {args.apikey}".encode()).hexdigest()[:16]
+    return(os.path.join(args.cache_dir, org, f"{endpoint}.json"))
+
+
+def read_cache(args, endpoint):
+    """
+    Read a cached endpoint
+
+    Returns
+    =======
+        cache   '(dict)' fetched/full timestamps and data, None if missing
+    """
+    try:
+        with open(get_cache_path(args, endpoint)) as f:
+            return(json.load(f))
+    except (IOError, ValueError):
+        return(None)
+
+
+def write_cache(args, endpoint, data, full):
+    """
+    Save an endpoint's data along with when it was last fetched and when it
+    was last fetched in full
+    """
+    path = get_cache_path(args, endpoint)
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        # Write then rename so a concurrent run never reads half a file
+        with open(path + ".tmp", "w") as f:
+            json.dump({"fetched": time.time(), "full": full, "data": data}, f)
+        os.replace(path + ".tmp", path)
+    except (IOError, OSError) as err:
+        logging.warning(f"Unable to write cache {path} {err}")
+
+
+def use_cache(args, endpoint):
+    """
+    Decide how much of an endpoint needs fetching
+
+    Returns
+    =======
+        tuple   '(str, dict)' "cache", "update" or "full" and the cache
+    """
+    cache = read_cache(args, endpoint)
+    if args.offline:
+        if cache is None:
+            logging.error(f"No cached {endpoint} for this org, run once without --offline")
+            sys.exit(1)
+        return("cache", cache)
+    if cache is None or args.cache_ttl <= 0:
+        return("full", cache)
+    age = time.time() - cache["fetched"]
+    if age < args.cache_ttl:
+        logging.info(f"Using cached {endpoint} from {int(age)}s ago")
+        return("cache", cache)
+    if time.time() - cache["full"] < cache_full_ttl:
+        return("update", cache)
+    return("full", cache)
+
+
+def get_cached_integrations(args, session):
+    """
+    get_integrations() through the cache.  A stale cache is topped up with
+    the metrics that became active since it was fetched, from
+    /api/v1/metrics?from=, instead of re-reading the whole catalogue.
+
+    Returns
+    =======
+        integrations    '(set)' Set of unique source.integrations
+    """
+    mode, cache = use_cache(args, "integrations")
+    if mode == "cache":
+        return(set(cache["data"]))
+    if mode == "update":
+        integrations = set(cache["data"])
+        try:
+            i = get_with_backoff(session, f"{args.url}/api/v1/metrics",
+                                 {"from": int(cache["fetched"])})
+            for metric in i.json().get("metrics", []):
+                integrations.add(get_integration(metric))
+            full = cache["full"]
+        except requests.exceptions.HTTPError as err:
+            logging.warning(f"Incremental metrics refresh failed {err}")
+            mode = "full"
+    if mode == "full":
+        integrations = get_integrations(args, session)
+        full = time.time()
+    if args.cache_ttl > 0:
+        write_cache(args, "integrations", sorted(integrations), full)
+    return(integrations)
+
+
+def get_cached_monitors(args, session):
+    """
+    get_monitors() through the cache.  A stale cache only asks for the
+    monitors created since, by id.  Edited and deleted monitors are picked
+    up by the full refresh once a day, as the monitor API has no modified
+    since filter.
+
+    Returns
+    =======
+        list    List of monitor dictionaries
+    """
+    mode, cache = use_cache(args, "monitors")
+    if mode == "cache":
+        return(cache["data"])
+    if mode == "update":
+        monitors = cache["data"]
+        last_id = max([m["id"] or 0 for m in monitors], default=0)
+        monitors.extend(get_monitors(args, session, id_offset=last_id))
+        full = cache["full"]
+    else:
+        monitors = get_monitors(args, session)
+        full = time.time()
+    # Only the parts the audit needs are kept
+    monitors = [{"id": m.get("id"), "query": m.get("query", "")}
+                for m in monitors]
+    if args.cache_ttl > 0:
+        write_cache(args, "monitors", monitors, full)
+    return(monitors)
+
+
+def get_cached_processes(args, session):
+    """
+    get_processes() through the cache.  Processes are a 15 minute view so
+    they are only ever fetched in full.
+
+    Returns
+    =======
+        processes   '(dict)' Set of integrations per host
+    """
+    mode, cache = use_cache(args, "processes")
+    if mode == "cache":
+        return({host: set(pcs) for host, pcs in cache["data"].items()})
+    processes = get_processes(args, session)
+    if args.cache_ttl > 0:
+        # Hosts can be None, which JSON can not use as a key
+        write_cache(args, "processes",
+                    {str(host): sorted(pcs) for host, pcs in processes.items()},
+                    time.time())
+    return(processes)
+
+
+def get_orgs(args):
+    """
+    Read the --orgs file, or build a single org from --apikey/--appkey.  Each
+    org gets its own copy of args so the per org url, keys and cache path
+    are used everywhere args is passed.
+
+    Returns
+    =======
+        orgs    '(list)' List of (name, args) tuples
+    """
+    if not args.orgs:
+        return([(args.url, args)])
+    try:
+        with open(args.orgs) as f:
+            config = json.load(f)
+    except (IOError, ValueError) as err:
+        logging.error(f"Unable to read orgs file {args.orgs} {err}")
+        sys.exit(1)
+    orgs = []
+    for org in config:
+        try:
+            org_args = argparse.Namespace(**vars(args))
+            org_args.apikey = org["apikey"]
+            org_args.appkey = org["appkey"]
+            org_args.url = org.get("url", args.url)
+            orgs.append((org.get("name", org_args.url), org_args))
+        except (KeyError, TypeError) as err:
+            logging.error(f"Org {org} in {args.orgs} is missing {err}")
+            sys.exit(1)
+    return(orgs)
+
+
+def find_gaps(integrations, monitors, processes, supported_index):
+    """
+    Evaluate the gaps between what was discovered, configured and monitored
+
+    Returns
+    =======
+        findings    '(generator)' (host, integration, finding) tuples
+    """
+    # Evaluate if any processes were found without integrations and/or monitors
+    for host, process in processes.items():
+        for pcs in sorted(process):
+            # Is the process/integration not found in metrics
+            # meaning it was detected but not configured?
+            if pcs not in integrations:
+                yield(host, pcs, "not_configured")
+
+    # Evaluate if any configured integrations are missing monitors
+    monitor_index = get_monitor_index(monitors)
+    for integration in sorted(integrations):
+        # If the integration metric is not found in any monitor
+        if not has_prefix(monitor_index, integration):
+            # If the integration is supported and has no monitor
+            if has_prefix(supported_index, integration):
+                yield(None, integration, "no_monitor")
+
+
+def audit_org(name, args, supported_index):
+    """
+    Collect and evaluate one org with its own session
+
+    Returns
+    =======
+        tuple   '(list, float, dict)' findings, seconds taken and the
+                seconds spent on each step
+    """
+    begin = time.time()
+    timings = {}
+    session = setup_session(args)
+    try:
+        for step, get in [("integrations", get_cached_integrations),
+                          ("monitors", get_cached_monitors),
+                          ("processes", get_cached_processes)]:
+            start = time.time()
+            timings[step] = (get(args, session), time.time() - start)
+    finally:
+        session.close()
+    findings = find_gaps(timings["integrations"][0], timings["monitors"][0],
+                         timings["processes"][0], supported_index)
+    findings = list(findings)
+    steps = {step: t[1] for step, t in timings.items()}
+    return(findings, time.time() - begin, steps)
+
+
+class FindingWriter():
+    """
+    Writes findings as they come in from the org workers, one at a time
+    """
+    def __init__(self, args):
+        self.format = args.format
+        # Log lines only name the org when there is more than one
+        self.prefix = "{} " if args.orgs else ""
+        self.lock = threading.Lock()
+        if self.format != "log" and args.output != "-":
+            self.file = open(args.output, "w", newline="")
+        else:
+            self.file = sys.stdout
+        if self.format == "csv":
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(finding_fields)
+
+    def write(self, org, findings):
+        with self.lock:
+            for host, integration, finding in findings:
+                if self.format == "log":
+                    if finding == "not_configured":
+                        logging.warning(
+                            f"ACTION REQUIRED: {self.prefix.format(org)}Integration {integration} identified on host: {host}, configure integration."
+                        )
+                    else:
+                        logging.warning(f"ACTION REQUIRED: {self.prefix.format(org)}{integration} has no monitor")
+                elif self.format == "csv":
+                    self.csv.writerow([org, host, integration, finding])
+                else:
+                    self.file.write(json.dumps(dict(zip(
+                        finding_fields, [org, host, integration, finding]))) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
 def main():
     """
     I shall peer into your environment's soul
@@ -333,31 +794,36 @@ def main():
             level=logging.INFO
         )
 
-    session = setup_session(args)
-    integrations = get_integrations(args, session)
-    monitors = get_monitors(args, session)
-    # dd_integrations = get_supported_integrations(args)
-    processes = get_processes(args, session)
-
-    # Evaluate if any processes were found without integrations and/or monitors
-    for host, process in processes.items():
-        for pcs in process:
-            # Is the process/integration not found in metrics
-            # meaning it was detected but not configured?
-            if pcs not in integrations:
-                logging.warning(
-                    f"ACTION REQUIRED: Integration {pcs} identified on host: {host}, configure integration."
-                )
-
-    # Evaluate if any configured integrations are missing monitors
-    for integration in integrations:
-        # If the integration metric is not found in any monitor
-        if next((i for i in monitors if integration in i['query']), None) is None:
-            # If the integration is supported and has no monitor
-            if next((i for i in pesa_supported if integration in i), None) is not None:
-                logging.warning(f"ACTION REQUIRED: {integration} has no monitor") 
-
-    session.close()
+    orgs = get_orgs(args)
+    supported_index = get_supported_index(args)
+    writer = FindingWriter(args)
+    timings = []
+    failed = 0
+    # Orgs are audited side by side, findings are written as each finishes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for name, org_args in orgs:
+            future = pool.submit(audit_org, name, org_args, supported_index)
+            futures[future] = name
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                findings, elapsed, steps = future.result()
+            except (Exception, SystemExit) as err:
+                # A single bad org should not stop the rest of the audit
+                logging.error(f"Audit of {name} failed {err}")
+                failed += 1
+                continue
+            writer.write(name, findings)
+            timings.append((name, elapsed, len(findings), steps))
+    writer.close()
+
+    # Slowest org first so a struggling tenant stands out
+    for name, elapsed, count, steps in sorted(timings, key=lambda t: -t[1]):
+        detail = " ".join(f"{step}={t:.1f}s" for step, t in steps.items())
+        logging.info(f"{name} audited in {elapsed:.1f}s with {count} findings ({detail})")
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
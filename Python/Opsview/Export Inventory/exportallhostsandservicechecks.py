@@ -4,6 +4,12 @@
 import requests
 import xlsxwriter
 import argparse
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import threading
 from configobj import ConfigObj
 import urllib3
 import pprint
@@ -11,6 +17,10 @@ import re
 import random
 import logging
 import os
+import sqlite3
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -28,11 +38,33 @@ opsview_hostgroup = opsview_url + '/config/hostgroup'
 opsview_service_list = opsview_url + '/status/service'
 opsview_testservicecheck = opsview_url + "/testservicecheck"
 
+# Rows per page for the paginated /config queries
+page_rows = 500
+# Hosts per /status/service call
+status_batch = 50
+
+# Hosts to keep in flight ahead of the writer, per worker
+hosts_per_worker = 4
+# Most hosts for the sheets layout, constant_memory keeps a temp file open
+# per worksheet until the workbook is closed
+max_sheets = 500
+# Host config that decides which service checks a host gets and their args,
+# a change to any of it marks the host for a refetch in delta mode
+host_marker_cols = "id,name,ip,other_addresses,hosttemplates,servicechecks,hostattributes"
+
 host_urls = []
 opsview_hosts_info = []
-opsview_hosts = []
+
+# Retry throttled and failed GETs with exponential backoff
+retry = Retry(total=5, backoff_factor=0.5,
+              status_forcelist=[429, 500, 502, 503, 504],
+              allowed_methods=["GET"])
 
 session = requests.Session()
+session.mount("https://", HTTPAdapter(max_retries=retry))
+session.mount("http://", HTTPAdapter(max_retries=retry))
+
+thread_local = threading.local()
 
 
 def parse_args():
@@ -41,6 +73,27 @@ def parse_args():
                            nargs="+", action="store", default=None)
     argparser.add_argument("-f", dest="host_file",
                            action="store", default=None)
+    argparser.add_argument("-a", dest="all_hosts", action="store_true",
+                           default=False,
+                           help="Export every host instead of -g or -f")
+    argparser.add_argument("-w", dest="workers", type=int,
+                           action="store", default=16,
+                           help="Concurrent API requests (default 16)")
+    argparser.add_argument("-o", dest="output", action="store",
+                           default="/tmp/host_export.xlsx",
+                           help="Export file, .xlsx, .csv or .jsonl "
+                           "(default /tmp/host_export.xlsx)")
+    argparser.add_argument("-l", dest="layout", action="store",
+                           choices=["long", "sheets"], default="long",
+                           help="xlsx layout, one sheet of host/service/args "
+                           "rows or one sheet per host, up to "
+                           f"{max_sheets} hosts (default long)")
+    argparser.add_argument("-d", dest="snapshot", action="store", default=None,
+                           help="SQLite snapshot from the last run, only hosts "
+                           "whose config changed are fetched again")
+    argparser.add_argument("-r", dest="report", action="store", default=None,
+                           help="Write added/removed/changed checks to this "
+                           ".csv or .jsonl file (needs -d)")
     args = argparser.parse_args()
     return args
 
@@ -77,17 +130,53 @@ def login():
         logging.error(f"There was an error: {err}")
 
 
-def get_host_groups(group):
-
+def get_session():
+    # requests.Session is not thread safe, each worker gets its own copy of
+    # the logged in session
+    worker_session = getattr(thread_local, "session", None)
+    if worker_session is None:
+        worker_session = requests.Session()
+        worker_session.headers.update(session.headers)
+        worker_session.verify = False
+        worker_session.mount("https://", HTTPAdapter(max_retries=retry))
+        worker_session.mount("http://", HTTPAdapter(max_retries=retry))
+        thread_local.session = worker_session
+    return worker_session
+
+
+def get_page(url, params, page):
+    req = get_session().get(url, params=dict(params, rows=page_rows, page=page))
+    req.raise_for_status()
+    return req.json()
+
+
+def get_pages(url, params, pool):
+    # Read the first page for the page count, then fetch the rest at once
+    first = get_page(url, params, 1)
+    items = first['list']
+    pages = int(first.get('summary', {}).get('totalpages', 1))
+    futures = [pool.submit(get_page, url, params, page)
+               for page in range(2, pages + 1)]
+    for future in futures:
+        items.extend(future.result()['list'])
+    return items
+
+
+def get_all_host_groups(pool):
+    host_groups = {}
     try:
-        new_opsview_url = opsview_url[0:len(opsview_url) - 5]
+        for group in get_pages(opsview_hostgroup,
+                               {"cols": "id,name,children,hosts"}, pool):
+            host_groups[group['ref']] = group
+    except Exception as err:
+        logging.error(f"There was an error: {err}")
+    return host_groups
+
 
-        newurl = new_opsview_url + group
-        newurl += '&cols=id&cols=name&cols=hostattributes'
+def get_host_groups(group, host_groups):
 
-        host_groups_request = session.get(
-            newurl, verify=False)
-        host_group = host_groups_request.json()['object']
+    try:
+        host_group = host_groups[group]
 
         host_children = host_group['children']
 
@@ -95,7 +184,7 @@ def get_host_groups(group):
 
         if children_count > 0:
             for child in host_children:
-                get_host_groups(child['ref'])
+                get_host_groups(child['ref'], host_groups)
         else:
             hosts = host_group['hosts']
             if len(hosts) != 0:
@@ -105,55 +194,58 @@ def get_host_groups(group):
         logging.error(f"There was an error: {err}")
 
 
-def get_host_group_urls(host_groups):
+def get_host_group_urls(names, host_groups):
 
     host_group_urls = []
 
-    for group in host_groups:
-        try:
-            newurl = opsview_hostgroup + \
-                '?json_filter={"name":"' + group + '"}'
-            newurl += '&cols=id&cols=name&cols=hostattributes'
-            host_groups_request = session.get(
-                newurl, verify=False)
-            host_groups_list_ref = host_groups_request.json()['list'][0]['ref']
-            host_group_urls.append(host_groups_list_ref)
-
-        except Exception as err:
-            logging.error(f"There was an error: {err}")
+    for group in names:
+        refs = [ref for ref, host_group in host_groups.items()
+                if host_group['name'] == group]
+        if refs:
+            host_group_urls.append(refs[0])
+        else:
+            logging.error(f"There was an error: host group {group} not found")
 
     return host_group_urls
 
 
-def get_opsview_hosts():
-    new_opsview_url = opsview_url[0:len(opsview_url) - 5]
-    for host_ref in host_urls:
-        try:
-            hostget = session.get(new_opsview_url + '{}?cols=id,name,ip,icon'.format(
-                host_ref), verify=False)
-            host = hostget.json()['object']
+def get_opsview_hosts(pool, all_hosts=False, cols="id,name"):
+    try:
+        hosts = get_pages(opsview_host, {"cols": cols}, pool)
+    except Exception as err:
+        logging.error(f"There was an error: {err}")
+        return None
+    if all_hosts:
+        for host in hosts:
             opsview_hosts_info.append(host['name'])
-        except Exception as err:
-            logging.error(f"There was an error: {err}. Host ref: {host_ref}")
-            pass
+        return hosts
+    names = {host['ref']: host['name'] for host in hosts}
+    for host_ref in host_urls:
+        if host_ref in names:
+            opsview_hosts_info.append(names[host_ref])
+        else:
+            logging.error(f"There was an error: not found. Host ref: {host_ref}")
+    return hosts
 
 
-def get_service_check_list(name):
+def get_service_check_list(names):
+    # /status/service takes several host= params, one call covers a batch
     try:
-        url = '{}?host={}'.format(opsview_service_list, name)
-        req = session.get(url)
+        params = [("host", name) for name in names]
+        params.append(("rows", len(names)))
+        req = get_session().get(opsview_service_list, params=params)
         j = req.json()['list']
-        d = {}
-        if len(j) > 0:
-            d['services'] = j[0]['services']
-            d['name'] = name
-            return d
-        else:
-            pprint.pprint(j)
-            return None
+        found = []
+        for entry in j:
+            found.append({'services': entry['services'],
+                          'name': entry['name']})
+        missing = set(names) - set(d['name'] for d in found)
+        if missing:
+            logging.error(f"Get service :{sorted(missing)}. Error no services")
+        return found
     except Exception as err:
-        pprint.pprint(f"Get service :{name}. Error{err}")
-        logging.error(f"Get service :{name}. Error{err}")
+        pprint.pprint(f"Get service :{names}. Error{err}")
+        logging.error(f"Get service :{names}. Error{err}")
         return None
 
 
@@ -169,69 +261,384 @@ def parse_services(data):
         logging.error(f"There was an error: {err}")
 
 
-def get_args(data):
+def get_service_args(name, service):
     try:
-        new_service_list = []
-        name = data['name']
-        for service in data['services']:
-            url = f"{opsview_testservicecheck}?hostname={name}&servicename={service}&cols=args"
-            req = session.get(url)
-            j = req.json()
-            if 'args' in j:
-                serv = {service: j['args']}
-                new_service_list.append(serv)
-            else:
-                print(j)
-        data['services'] = new_service_list
-        return data
+        req = get_session().get(opsview_testservicecheck, params={
+            "hostname": name, "servicename": service, "cols": "args"})
+        j = req.json()
+        if 'args' in j:
+            return {service: j['args']}
+        else:
+            print(j)
     except Exception as err:
         print(err)
-
-
-def write_to_sheet():
+        logging.error(f"Get args :{name} {service}. Error{err}")
+    return None
+
+
+def get_args(data, futures):
+    data['services'] = [service for service in
+                        (future.result() for future in futures) if service]
+    data['failed'] = len(futures) - len(data['services'])
+    return data
+
+
+class SheetWriter:
+    # constant_memory flushes each row as soon as the next one starts, so
+    # rows must be written in order and a sheet can not be revisited
+    def __init__(self, path, layout):
+        self.workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        self.layout = layout
+        self.sheet_names = set()
+        if layout == "long":
+            self.worksheet = self.workbook.add_worksheet("Service Checks")
+            self.worksheet.write_row(0, 0, ["Host", "Service Check", "Arguments"])
+            self.row = 1
+
+    def sheet_name(self, name):
+        # Sheet names are limited to 31 characters and must be unique
+        name = name[0:30]
+        base = name
+        count = 1
+        while name.lower() in self.sheet_names:
+            suffix = f"~{count}"
+            name = base[0:30 - len(suffix)] + suffix
+            count += 1
+        self.sheet_names.add(name.lower())
+        return name
+
+    def write_host(self, host):
+        if self.layout == "long":
+            for service in host['services']:
+                for key, value in service.items():
+                    self.worksheet.write_row(self.row, 0, [host['name'], key, value])
+                    self.row += 1
+            return
+        worksheet = self.workbook.add_worksheet(self.sheet_name(host['name']))
+        col = 0
+        row = 1
+        worksheet.write(0, 0, "Service Check")
+        worksheet.write(0, 1, "Arguments")
+        for service in host['services']:
+            for key, value in service.items():
+                worksheet.write(row, col, key)
+                worksheet.write(row, col + 1, value)
+                row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["Host", "Service Check", "Arguments"])
+
+    def write_host(self, host):
+        for service in host['services']:
+            for key, value in service.items():
+                self.writer.writerow([host['name'], key, value])
+
+    def close(self):
+        self.file.close()
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def write_host(self, host):
+        self.file.write(json.dumps({'name': host['name'],
+                                    'services': host['services']}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def open_writer(args):
+    if args.output.endswith(".csv"):
+        return CsvWriter(args.output)
+    elif args.output.endswith(".jsonl"):
+        return JsonlWriter(args.output)
+    layout = args.layout
+    if layout == "sheets" and len(opsview_hosts_info) > max_sheets:
+        message = (f"{len(opsview_hosts_info)} hosts is more than {max_sheets} "
+                   "sheets can hold open, using the long layout")
+        logging.warning(message)
+        print(message)
+        layout = "long"
+    return SheetWriter(args.output, layout)
+
+
+def write_host(writer, host):
     try:
-        workbook = xlsxwriter.Workbook(
-            "/tmp/host_export.xlsx")
-        for host in opsview_hosts:
-            if host is not None:
-                name = host['name']
-                if len(name) > 31:
-                    name = name[0:30]
-                worksheet = workbook.add_worksheet(name)
-                col = 0
-                row = 1
-                worksheet.write(0, 0, "Service Check")
-                worksheet.write(0, 1, "Arguments")
-                for service in host['services']:
-                    for key, value in service.items():
-                        worksheet.write(row, col, key)
-                        worksheet.write(row, col + 1, value)
-                        row += 1
-        workbook.close()
+        writer.write_host(host)
     except Exception as err:
-        logging.error(f"There was an error writing excel: {err}")
-        pass
+        logging.error(f"There was an error writing {host['name']}: {err}")
+
+
+def get_marker(obj):
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def get_object_markers(pool, url, cols):
+    markers = {}
+    for obj in get_pages(url, {"cols": cols}, pool):
+        markers[obj['name']] = get_marker(obj)
+    return markers
+
+
+class Snapshot:
+    # host -> services -> args from the last run, with a hash of the config
+    # each host, host template and service check had at the time
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hosts "
+                        "(name TEXT PRIMARY KEY, marker TEXT, templates TEXT, updated REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checks "
+                        "(host TEXT, service TEXT, args TEXT, PRIMARY KEY (host, service))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS objects "
+                        "(kind TEXT, name TEXT, marker TEXT, PRIMARY KEY (kind, name))")
+        self.report = None
+        self.changes = collections.Counter()
+
+    def get_markers(self, kind):
+        return dict(self.db.execute(
+            "SELECT name, marker FROM objects WHERE kind = ?", (kind,)))
+
+    def set_markers(self, kind, markers):
+        with self.db:
+            self.db.execute("DELETE FROM objects WHERE kind = ?", (kind,))
+            self.db.executemany("INSERT INTO objects VALUES (?, ?, ?)",
+                                [(kind, name, marker) for name, marker in markers.items()])
+
+    def get_dirty_hosts(self, names, hosts, templates, servicechecks):
+        # A host is fetched again when it is new, its own config changed,
+        # or one of its host templates or service checks changed
+        old_templates = self.get_markers("hosttemplate")
+        changed_templates = set(name for name, marker in templates.items()
+                                if old_templates.get(name) != marker)
+        old_servicechecks = self.get_markers("servicecheck")
+        changed_services = [name for name, marker in servicechecks.items()
+                            if old_servicechecks.get(name) != marker]
+        dirty = set()
+        for service in changed_services:
+            for (host,) in self.db.execute(
+                    "SELECT host FROM checks WHERE service = ?", (service,)):
+                dirty.add(host)
+        stored = {name: (marker, json.loads(host_templates)) for name, marker, host_templates
+                  in self.db.execute("SELECT name, marker, templates FROM hosts")}
+        for name in names:
+            host = hosts.get(name)
+            if name not in stored or host is None:
+                dirty.add(name)
+            elif stored[name][0] != get_marker(host):
+                dirty.add(name)
+            elif changed_templates.intersection(stored[name][1]):
+                dirty.add(name)
+        return [name for name in names if name in dirty]
+
+    def report_change(self, change, host, service, old_args, new_args):
+        self.changes[change] += 1
+        if self.report is not None:
+            self.report.write_change(change, host, service, old_args, new_args)
+
+    def write_host(self, host, config=None):
+        old = dict(self.db.execute(
+            "SELECT service, args FROM checks WHERE host = ?", (host['name'],)))
+        new = {}
+        for service in host['services']:
+            new.update(service)
+        for service, args in new.items():
+            if service not in old:
+                self.report_change("added", host['name'], service, None, args)
+            elif old[service] != args:
+                self.report_change("changed", host['name'], service, old[service], args)
+        # A service whose args could not be read is not gone, keep the old
+        # row and leave the host marked for another try next run
+        if host.get('failed'):
+            new = dict(old, **new)
+        for service in old:
+            if service not in new:
+                self.report_change("removed", host['name'], service, old[service], None)
+        with self.db:
+            self.db.execute("DELETE FROM checks WHERE host = ?", (host['name'],))
+            self.db.executemany("INSERT INTO checks VALUES (?, ?, ?)",
+                                [(host['name'], service, args) for service, args in new.items()])
+            if config is not None and not host.get('failed'):
+                templates = [t['name'] for t in config.get('hosttemplates', [])]
+                self.db.execute("INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?)",
+                                (host['name'], get_marker(config), json.dumps(templates),
+                                 time.time()))
+        if host.get('failed'):
+            self.clear_marker(host['name'])
+
+    def clear_marker(self, name):
+        # The host may only be dirty because a template or service check
+        # changed, and those markers are saved at the end of the run.  With
+        # no marker of its own it is fetched again next run.
+        with self.db:
+            self.db.execute("UPDATE hosts SET marker = NULL WHERE name = ?", (name,))
+
+    def remove_missing_hosts(self, hosts):
+        for (name,) in self.db.execute("SELECT name FROM hosts").fetchall():
+            if name not in hosts:
+                self.write_host({'name': name, 'services': []})
+                with self.db:
+                    self.db.execute("DELETE FROM hosts WHERE name = ?", (name,))
+
+    def read_host(self, name):
+        services = [{service: args} for service, args in self.db.execute(
+            "SELECT service, args FROM checks WHERE host = ? ORDER BY rowid", (name,))]
+        return {'name': name, 'services': services}
+
+    def close(self):
+        self.db.close()
+
+
+class SnapshotSink:
+    # Stands in for the export writer while the changed hosts are fetched
+    def __init__(self, snapshot, hosts):
+        self.snapshot = snapshot
+        self.hosts = hosts
+        self.written = set()
+
+    def write_host(self, host):
+        self.snapshot.write_host(host, self.hosts.get(host['name']))
+        self.written.add(host['name'])
+
+
+class ReportWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.csv = csv.writer(self.file) if path.endswith(".csv") else None
+        if self.csv:
+            self.csv.writerow(["Change", "Host", "Service Check",
+                               "Old Arguments", "New Arguments"])
+
+    def write_change(self, change, host, service, old_args, new_args):
+        if self.csv:
+            self.csv.writerow([change, host, service, old_args, new_args])
+        else:
+            self.file.write(json.dumps({"change": change, "host": host,
+                                        "service": service, "old_args": old_args,
+                                        "new_args": new_args}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+def fetch_hosts(pool, names, writer, window):
+    # Queue each host's /testservicecheck calls as soon as its service
+    # list arrives and write hosts out in order as they complete.  Only
+    # a window of hosts is held at a time so memory stays flat however
+    # big the estate is.  Returns the hosts /status/service answered for
+    # without listing them.
+    batches = [names[i:i + status_batch]
+               for i in range(0, len(names), status_batch)]
+    pending = collections.deque()
+    missing = []
+    next_batch = pool.submit(get_service_check_list, batches[0]) if batches else None
+    for index in range(len(batches)):
+        service_lists = next_batch.result()
+        if index + 1 < len(batches):
+            next_batch = pool.submit(get_service_check_list, batches[index + 1])
+        if service_lists is None:
+            continue
+        found = set(services.get('name') for services in service_lists)
+        missing.extend(name for name in batches[index] if name not in found)
+        for services in service_lists:
+            parsed_services = parse_services(services)
+            if parsed_services:
+                futures = [pool.submit(get_service_args,
+                                       parsed_services['name'], service)
+                           for service in parsed_services['services']]
+                pending.append((parsed_services, futures))
+            while len(pending) > window:
+                write_host(writer, get_args(*pending.popleft()))
+    while pending:
+        write_host(writer, get_args(*pending.popleft()))
+    return missing
+
+
+def run_delta(args, pool, hosts, writer, window):
+    try:
+        templates = get_object_markers(pool, opsview_url + '/config/hosttemplate',
+                                       "id,name,servicechecks")
+        servicechecks = get_object_markers(pool, opsview_url + '/config/servicecheck',
+                                           "id,name,args,plugin,checktype")
+    except Exception as err:
+        logging.error(f"There was an error reading change markers: {err}")
+        return
+    hosts = {host['name']: host for host in hosts}
+    snapshot = Snapshot(args.snapshot)
+    try:
+        if args.report:
+            snapshot.report = ReportWriter(args.report)
+        dirty = snapshot.get_dirty_hosts(opsview_hosts_info, hosts, templates, servicechecks)
+        print(f"Fetching {len(dirty)} of {len(opsview_hosts_info)} hosts")
+        sink = SnapshotSink(snapshot, hosts)
+        missing = fetch_hosts(pool, dirty, sink, window)
+        # A changed host that /status/service no longer lists has no checks
+        # left, clear its rows so the removals are reported and purged
+        for name in missing:
+            sink.write_host({'name': name, 'services': []})
+        # Hosts whose /status/service batch failed were never written
+        for name in dirty:
+            if name not in sink.written:
+                snapshot.clear_marker(name)
+        snapshot.remove_missing_hosts(hosts)
+        snapshot.set_markers("hosttemplate", templates)
+        snapshot.set_markers("servicecheck", servicechecks)
+        # The export is always complete, unchanged hosts come from the snapshot
+        for name in opsview_hosts_info:
+            write_host(writer, snapshot.read_host(name))
+        print("Checks added: {added}, removed: {removed}, changed: {changed}".format(
+            **{c: snapshot.changes[c] for c in ("added", "removed", "changed")}))
+    finally:
+        if snapshot.report is not None:
+            snapshot.report.close()
+        snapshot.close()
 
 
 def main():
     args = parse_args()
     login()
-    if args.host_groups:
-        hg_urls = get_host_group_urls(args.host_groups)
-        for h_url in hg_urls:
-            get_host_groups(h_url)
-        get_opsview_hosts()
-    elif args.host_file:
-        hosts = parse_host_file(args.host_file)
-        for host in hosts:
-            opsview_hosts_info.append(host)
-    for host in opsview_hosts_info:
-        services = get_service_check_list(host)
-        if services:
-            parsed_services = parse_services(services)
-            all_data = get_args(parsed_services)
-            opsview_hosts.append(all_data)
-    write_to_sheet()
+    # Delta runs need every host's config to spot the changed ones
+    cols = host_marker_cols if args.snapshot else "id,name"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        hosts = None
+        if args.host_groups:
+            host_groups = get_all_host_groups(pool)
+            hg_urls = get_host_group_urls(args.host_groups, host_groups)
+            for h_url in hg_urls:
+                get_host_groups(h_url, host_groups)
+            hosts = get_opsview_hosts(pool, cols=cols)
+        elif args.host_file:
+            hosts = parse_host_file(args.host_file)
+            for host in hosts:
+                opsview_hosts_info.append(host)
+            hosts = get_opsview_hosts(pool, cols=cols) if args.snapshot else None
+        elif args.all_hosts:
+            hosts = get_opsview_hosts(pool, all_hosts=True, cols=cols)
+        try:
+            writer = open_writer(args)
+        except Exception as err:
+            logging.error(f"There was an error opening {args.output}: {err}")
+            return
+        window = args.workers * hosts_per_worker
+        if args.snapshot:
+            if hosts is None:
+                logging.error("There was an error: no host list, snapshot left as is")
+            else:
+                run_delta(args, pool, hosts, writer, window)
+        else:
+            fetch_hosts(pool, opsview_hosts_info, writer, window)
+        try:
+            writer.close()
+        except Exception as err:
+            logging.error(f"There was an error writing {args.output}: {err}")
 
 
 if __name__ == '__main__':
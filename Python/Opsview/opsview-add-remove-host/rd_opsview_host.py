@@ -8,24 +8,50 @@ Date:           2019-07-29
 '''
 ###############################################################################
 import argparse
+import collections
+import concurrent.futures
+import copy
 import json
+import os
+import queue
 import requests
 import pprint
 import sys
+import threading
+import time
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# requests.Session is not thread safe, each thread keeps its own keep-alive
+# session and the login token is passed in the headers of every call
+thread_local = threading.local()
+# Templates are read once per process, a worker reuses them for every event
+templates = {}
+
+
+# Keep-alive session for the calling thread
+###############################################################################
+def get_session():
+    session = getattr(thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        thread_local.session = session
+    return(session)
+
 
 # Parse Arguments
 ###############################################################################
 def get_args():
     action_list = ['add', 'remove']
     parser = argparse.ArgumentParser(
-        usage='%(prog)s -H -I -O --add --remove',
+        usage='%(prog)s -H -I -O --add --remove\n'
+              '       %(prog)s --batch EVENTS --url -u -p [defaults]\n'
+              '       %(prog)s --worker SPOOL --url -u -p [defaults]\n'
+              '       %(prog)s --enqueue SPOOL -H -I -O --action',
         description='Automation script to perform operations on Opsview hosts'
     )
     parser.add_argument(
-        '-H', '--hostname', action='store', required=True, metavar='',
+        '-H', '--hostname', action='store', required=False, metavar='',
         help='Instance Hostname'
     )
     parser.add_argument(
@@ -74,10 +100,51 @@ def get_args():
         help='WinRM Password Opsview will use to monitor the instance'
     )
     parser.add_argument(
-        '--url', action='store', required=True, metavar='',
-        help='Opsview API URL'
+        '--url', action='store', required=False, metavar='',
+        help='Opsview API URL, not needed with --enqueue'
+    )
+    parser.add_argument(
+        '--batch', action='store', required=False, metavar='',
+        help='File of add/remove events, one JSON object per line, or - to\n'
+             'read a stream from stdin.  Each event carries action, hostname\n'
+             'and whatever differs from the options given here, i.e.\n'
+             '{"action": "add", "hostname": "web01", "ip": "10.0.0.5", "os": "linux"}'
+    )
+    parser.add_argument(
+        '--window', action='store', type=float, default=10, metavar='',
+        help='Seconds without a new event that close a batch and trigger\n'
+             'its single reload (Default 10)'
+    )
+    parser.add_argument(
+        '--workers', action='store', type=int, default=10, metavar='',
+        help='Hosts to add or remove at the same time (Default 10)'
+    )
+    parser.add_argument(
+        '--worker', action='store', required=False, metavar='',
+        help='Run as a long-lived worker consuming events from this spool\n'
+             'directory, one JSON event per *.json file'
+    )
+    parser.add_argument(
+        '--enqueue', action='store', required=False, metavar='',
+        help='Drop this host\'s add/remove event into the spool directory\n'
+             'for the worker instead of calling Opsview'
+    )
+    parser.add_argument(
+        '--poll', action='store', type=float, default=1, metavar='',
+        help='Seconds between spool scans in worker mode (Default 1)'
+    )
+    parser.add_argument(
+        '--keepalive', action='store', type=float, default=300, metavar='',
+        help='Seconds of idle time before the worker refreshes its Opsview\n'
+             'token (Default 300)'
     )
     args = parser.parse_args()
+    if not (args.batch or args.worker) and not args.hostname:
+        parser.error('-H/--hostname is required unless --batch or --worker is used')
+    if args.enqueue and not args.action:
+        parser.error('--action is required with --enqueue')
+    if not args.enqueue and not args.url:
+        parser.error('--url is required unless --enqueue is used')
     return(args)
 
 
@@ -87,7 +154,7 @@ def get_headers(args):
     url = args.url
     headers = {'Content-Type': 'application/json'}
     try:
-        ol = requests.post(
+        ol = get_session().post(
             url+'/login',
             auth=(args.user, args.password),
             headers=headers, verify=False
@@ -103,6 +170,14 @@ def get_headers(args):
 # Get Host Template
 ###############################################################################
 def get_template(args):
+    # update_template() changes the template, hand out copies of the cache
+    os_name = str(args.os).lower()
+    if os_name not in templates:
+        templates[os_name] = read_template(args)
+    return(copy.deepcopy(templates[os_name]))
+
+
+def read_template(args):
     # If this is a Linux host, grab the Linux template
     if args.os.lower() == 'linux':
         try:
@@ -155,7 +230,7 @@ def update_template(args, template):
 def add_host(args, headers, host):
     url = args.url+'/config/host'
     try:
-        res = requests.post(
+        res = get_session().post(
             url,
             data=json.dumps(host),
             headers=headers,
@@ -173,7 +248,7 @@ def add_host(args, headers, host):
 def remove_host(args, headers):
     url = args.url+'/config/host'
     try:
-        i = requests.get(
+        i = get_session().get(
             url+'?json_filter={"name": "'+args.hostname+'"}&cols=id',
             headers=headers,
             verify=False
@@ -184,7 +259,7 @@ def remove_host(args, headers):
         print('ERROR - '+str(err))
         sys.exit(1)
     try:
-        res = requests.delete(
+        res = get_session().delete(
             url+'/'+host+'?changelog=Automated host removal by Rundeck',
             headers=headers,
             verify=False
@@ -200,7 +275,7 @@ def remove_host(args, headers):
 def reload_opsview(args, headers):
     url = args.url+'/reload?changelog=Automated reload from Rundeck'
     try:
-        rel = requests.post(
+        rel = get_session().post(
             url,
             headers=headers,
             verify=False
@@ -220,12 +295,367 @@ def reload_opsview(args, headers):
         sys.exit(1)
 
 
+# Reload once nothing else is reloading
+###############################################################################
+def reload_when_ready(args, headers, attempts=10):
+    for attempt in range(attempts):
+        try:
+            # server_status 1 means a reload is already running
+            status = get_session().get(args.url+'/reload', headers=headers,
+                                       verify=False).json()
+            if str(status.get('server_status')) == '1':
+                print('Reload in progress, waiting')
+                time.sleep(min(60, 5 * (attempt + 1)))
+                continue
+        except Exception as err:
+            print('ERROR - Unable to get reload status '+str(err))
+        try:
+            reload_opsview(args, headers)
+            return(True)
+        except SystemExit:
+            time.sleep(min(60, 5 * (attempt + 1)))
+    print('ERROR - Gave up reloading Opsview after {} attempts'.format(attempts))
+    return(False)
+
+
+# Batch add/remove
+###############################################################################
+def get_event_args(args, event):
+    # Events only need the fields that differ from the command line
+    event_args = argparse.Namespace(**vars(args))
+    for key, value in event.items():
+        setattr(event_args, key, value)
+    if isinstance(event_args.ip, str):
+        event_args.ip = [event_args.ip]
+    return(event_args)
+
+
+def run_event(args, headers, event):
+    event_args = get_event_args(args, event)
+    # The single host functions exit on errors, keep the rest of the batch
+    # going and report this one as failed
+    try:
+        if event_args.action == 'add':
+            template = get_template(event_args)
+            host = update_template(event_args, template)
+            result = add_host(event_args, headers, host)
+            ok = result.status_code == 200
+        elif event_args.action == 'remove':
+            result = remove_host(event_args, headers)
+            ok = result.json()['success'] == '1'
+        else:
+            return(False, 'Unknown action '+str(event_args.action))
+    except SystemExit:
+        return(False, 'see errors above')
+    except Exception as err:
+        return(False, str(err))
+    if ok:
+        return(True, 'OK')
+    return(False, result.text)
+
+
+def run_host_events(args, headers, events):
+    # Events for one host run in order, different hosts run in parallel
+    results = []
+    for event in events:
+        results.append((event, run_event(args, headers, event)))
+    return(results)
+
+
+def run_batch(args, headers, events):
+    hosts = collections.OrderedDict()
+    for event in events:
+        hosts.setdefault(event.get('hostname'), []).append(event)
+    changed = 0
+    failed = 0
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [pool.submit(run_host_events, args, headers, host_events)
+                for host_events in hosts.values()]
+        for job in jobs:
+            for event, (ok, message) in job.result():
+                results.append((event, ok))
+                if ok:
+                    changed += 1
+                    print('OK - {} {}'.format(event['action'], event['hostname']))
+                else:
+                    failed += 1
+                    print('ERROR - {} {} {}'.format(
+                        event.get('action'), event.get('hostname'), message))
+    print('Batch of {} events: {} applied, {} failed'.format(
+        len(events), changed, failed))
+    # One reload covers every change in the batch
+    reloaded = True
+    if changed:
+        print('Reloading Opsview')
+        reloaded = reload_when_ready(args, headers)
+    return(results, reloaded)
+
+
+def read_events(stream, events):
+    for line in stream:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            event = json.loads(line)
+            if event.get('action') not in ('add', 'remove') or not event.get('hostname'):
+                raise ValueError('needs an add/remove action and a hostname')
+        except ValueError as err:
+            print('ERROR - Skipping event {} {}'.format(line, str(err)))
+            continue
+        events.put(event)
+    events.put(None)
+
+
+def run_batches(args, headers):
+    try:
+        stream = sys.stdin if args.batch == '-' else open(args.batch)
+    except IOError as err:
+        print('ERROR reading events '+str(err))
+        sys.exit(1)
+    events = queue.Queue()
+    threading.Thread(target=read_events, args=(stream, events),
+                     daemon=True).start()
+    failed = 0
+    done = False
+    while not done:
+        # Collect events until the stream goes quiet for --window seconds,
+        # so a burst of autoscaling events becomes one batch and one reload,
+        # or the batch has waited three windows under constant churn
+        batch = []
+        event = events.get()
+        started = time.time()
+        while event is not None:
+            batch.append(event)
+            wait = min(args.window, started + 3 * args.window - time.time())
+            if wait <= 0:
+                break
+            try:
+                event = events.get(timeout=wait)
+            except queue.Empty:
+                break
+        else:
+            done = True
+        if batch:
+            results, reloaded = run_batch(args, headers, batch)
+            failed += len([ok for event, ok in results if not ok])
+            failed += 0 if reloaded else 1
+    if failed:
+        sys.exit(1)
+
+
+# Spool directory worker
+###############################################################################
+def enqueue_event(args):
+    event = {
+        'action': args.action,
+        'hostname': args.hostname,
+        'queued': time.time()
+    }
+    for key in ('ip', 'os', 'slave', 'hostgroup'):
+        if getattr(args, key):
+            event[key] = getattr(args, key)
+    name = '{}-{}.json'.format(time.time_ns(), args.hostname)
+    path = os.path.join(args.enqueue, name)
+    try:
+        # Write then rename so the worker never reads half an event
+        with open(path+'.tmp', 'w') as f:
+            json.dump(event, f)
+        os.rename(path+'.tmp', path)
+    except (IOError, OSError) as err:
+        print('ERROR queueing event '+str(err))
+        sys.exit(1)
+    print('OK - Queued {} {}'.format(args.action, args.hostname))
+
+
+def claim_events(spool):
+    events = []
+    for name in sorted(os.listdir(spool)):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(spool, name)
+        # Renaming claims the file, a restarted worker puts .work files back
+        try:
+            os.rename(path, path+'.work')
+            with open(path+'.work') as f:
+                event = json.load(f)
+            if event.get('action') not in ('add', 'remove') or not event.get('hostname'):
+                raise ValueError('needs an add/remove action and a hostname')
+        except (IOError, OSError, ValueError) as err:
+            print('ERROR - Bad event {} {}'.format(name, str(err)))
+            finish_event({'spool_file': path+'.work'}, False)
+            continue
+        event['spool_file'] = path+'.work'
+        event.setdefault('queued', os.path.getmtime(path+'.work'))
+        events.append(event)
+    return(events)
+
+
+def finish_event(event, ok):
+    path = event['spool_file']
+    try:
+        if ok:
+            os.remove(path)
+        else:
+            # Keep failures for a look, or to be moved back into the spool
+            failed = os.path.join(os.path.dirname(path), 'failed')
+            os.makedirs(failed, exist_ok=True)
+            os.rename(path, os.path.join(failed, os.path.basename(path)[:-5]))
+    except OSError as err:
+        print('ERROR - Unable to clean up {} {}'.format(path, str(err)))
+
+
+def dedupe_events(events):
+    '''
+    Collapse each host's events in a batch to what is left once the flapping
+    is done.  The host may already have been in Opsview before the batch,
+    so add..remove still removes it, any remove followed by an add is a
+    remove then a fresh add, and repeats only need the last one.
+
+    >>> kept, dropped = dedupe_events([
+    ...     {'action': 'add', 'hostname': 'web01'},
+    ...     {'action': 'remove', 'hostname': 'web01'}])
+    >>> [event['action'] for event in kept]
+    ['remove']
+    >>> kept, dropped = dedupe_events([
+    ...     {'action': 'add', 'hostname': 'web01'},
+    ...     {'action': 'remove', 'hostname': 'web01'},
+    ...     {'action': 'add', 'hostname': 'web01'}])
+    >>> [event['action'] for event in kept]
+    ['remove', 'add']
+    '''
+    hosts = collections.OrderedDict()
+    for event in events:
+        hosts.setdefault(event['hostname'], []).append(event)
+    kept = []
+    dropped = []
+    for host_events in hosts.values():
+        last = host_events[-1]
+        removes = [e for e in host_events if e['action'] == 'remove']
+        if last['action'] == 'add' and removes:
+            keep = [removes[-1], last]
+        else:
+            keep = [last]
+        kept.extend(keep)
+        dropped.extend(e for e in host_events if not any(e is k for k in keep))
+    return(kept, dropped)
+
+
+def keep_token_alive(args, headers):
+    # Any API call resets the token's idle timer, log in again if it has
+    # expired anyway
+    try:
+        res = get_session().get(args.url+'/info', headers=headers, verify=False)
+        if res.status_code != 401:
+            return(headers)
+    except Exception as err:
+        print('ERROR - Token keepalive failed '+str(err))
+    print('Logging in to Opsview again')
+    return(get_headers(args))
+
+
+def report_latency(results, totals):
+    now = time.time()
+    latencies = []
+    for event, ok in results:
+        latency = now - float(event['queued'])
+        latencies.append(latency)
+        print('{} {} {} latency={:.2f}s'.format(
+            'OK' if ok else 'ERROR', event['action'], event['hostname'], latency))
+    if not latencies:
+        return
+    latencies.sort()
+    totals['events'] += len(latencies)
+    totals['latency'] += sum(latencies)
+    totals['max'] = max(totals['max'], latencies[-1])
+    print('Batch latency avg={:.2f}s p95={:.2f}s max={:.2f}s, '
+          'overall events={} avg={:.2f}s max={:.2f}s'.format(
+              sum(latencies) / len(latencies),
+              latencies[int(0.95 * (len(latencies) - 1))],
+              latencies[-1],
+              totals['events'],
+              totals['latency'] / totals['events'],
+              totals['max']))
+
+
+def run_worker(args, headers):
+    spool = args.worker
+    try:
+        os.makedirs(spool, exist_ok=True)
+        # Events a stopped worker had claimed go back in the queue
+        for name in os.listdir(spool):
+            if name.endswith('.work'):
+                os.rename(os.path.join(spool, name), os.path.join(spool, name[:-5]))
+    except OSError as err:
+        print('ERROR using spool '+str(err))
+        sys.exit(1)
+    totals = {'events': 0, 'latency': 0.0, 'max': 0.0}
+    pending_reload = False
+    last_call = time.time()
+    print('Watching {} for host events'.format(spool))
+    while True:
+        batch = claim_events(spool)
+        if not batch:
+            if pending_reload:
+                pending_reload = not reload_when_ready(args, headers)
+                last_call = time.time()
+            if time.time() - last_call > args.keepalive:
+                headers = keep_token_alive(args, headers)
+                last_call = time.time()
+            time.sleep(args.poll)
+            continue
+        # Keep collecting until the spool is quiet for --window seconds, or
+        # the batch has waited three windows under constant churn
+        started = quiet = time.time()
+        while time.time() - quiet < args.window and time.time() - started < 3 * args.window:
+            time.sleep(args.poll)
+            more = claim_events(spool)
+            if more:
+                batch.extend(more)
+                quiet = time.time()
+        if time.time() - last_call > args.keepalive:
+            headers = keep_token_alive(args, headers)
+        events, dropped = dedupe_events(batch)
+        for event in dropped:
+            finish_event(event, True)
+        if dropped:
+            print('Dropped {} flapping or repeated events'.format(len(dropped)))
+        results = []
+        reloaded = True
+        if events:
+            results, reloaded = run_batch(args, headers, events)
+        last_call = time.time()
+        for event, ok in results:
+            # A change that is not reloaded yet is still applied, so only
+            # the event's own result counts
+            finish_event(event, ok)
+        if not reloaded:
+            print('WARNING - Changes are waiting for the next reload')
+            pending_reload = True
+        report_latency(results, totals)
+
+
 # Main git-r-done ...
 ###############################################################################
 def main():
     args = get_args()
+    if args.enqueue:
+        enqueue_event(args)
+        return
     headers = get_headers(args)
 
+    if args.worker:
+        try:
+            run_worker(args, headers)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.batch:
+        run_batches(args, headers)
+        return
+
     # Parse options and decide what to do
     if args.action == 'add':
         template = get_template(args)
@@ -4,10 +4,28 @@ Script to get all alert definitions from Prometheus
 '''
 
 import argparse
+import concurrent.futures
 import csv
 import json
 import pprint
 import requests
+import sys
+import threading
+import time
+# Optional streaming JSON parser, without it each response is read whole
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+columns = [
+    'alert', 'query', 'endpoint', 'group', 'file', 'interval', 'type',
+    'duration', 'labels', 'annotations', 'health', 'lastError',
+    'lastEvaluation', 'evaluationTime'
+]
+# Extra columns written by --profile --replay
+replay_columns = ['replayTime', 'evalTotalTime', 'samples', 'series']
+local = threading.local()
 
 
 def get_args():
@@ -26,46 +44,385 @@ def get_args():
         '--port',
         action='store',
         default='9090',
-        help='Prometheus api port (default 9090)'
+        help='Prometheus api port used when no endpoint is given (default 9090)'
+    )
+    parser.add_argument(
+        '-e',
+        '--endpoint',
+        action='append',
+        default=[],
+        help='Prometheus/Thanos base url, can be repeated (i.e. https://thanos:9090)'
+    )
+    parser.add_argument(
+        '--endpoints-file',
+        action='store',
+        help='File with one Prometheus/Thanos base url per line'
+    )
+    parser.add_argument(
+        '-t',
+        '--type',
+        action='store',
+        choices=['alert', 'record', 'all'],
+        default='alert',
+        help='Rule type to export (default alert)'
+    )
+    parser.add_argument(
+        '-g',
+        '--group',
+        action='append',
+        default=[],
+        help='Only export this rule group (rule_group[]), can be repeated'
     )
-    return(parser.parse_args())
+    parser.add_argument(
+        '-m',
+        '--match',
+        action='append',
+        default=[],
+        help='Only export rules with matching labels (match[]), can be repeated'
+    )
+    parser.add_argument(
+        '--group-limit',
+        action='store',
+        type=int,
+        default=0,
+        help='Page through the rule groups this many at a time (needs Prometheus 3.x, default off)'
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        action='store',
+        type=int,
+        default=8,
+        help='Endpoints to query at the same time (default 8)'
+    )
+    parser.add_argument(
+        '--timeout',
+        action='store',
+        type=int,
+        default=60,
+        help='Seconds to wait on each request (default 60)'
+    )
+    parser.add_argument(
+        '-f',
+        '--format',
+        action='store',
+        choices=['csv', 'jsonl'],
+        default='csv',
+        help='Output format (default csv)'
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        action='store',
+        default=None,
+        help='File to write to, - for stdout (default openshift_alerts.csv)\n'
+        'With --profile the per rule costs are only written when this is set'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help='Report the most expensive rules and groups instead of exporting them'
+    )
+    parser.add_argument(
+        '--top',
+        action='store',
+        type=int,
+        default=20,
+        help='Rules and groups to list in the profile (default 20)'
+    )
+    parser.add_argument(
+        '--ratio',
+        action='store',
+        type=float,
+        default=0.8,
+        help='Flag groups whose evaluation takes this share of their interval (default 0.8)'
+    )
+    parser.add_argument(
+        '--replay',
+        action='store_true',
+        default=False,
+        help='Also run every rule query through /api/v1/query and time it'
+    )
+    args = parser.parse_args()
+    if args.output is None and not args.profile:
+        args.output = 'openshift_alerts.csv'
+    if args.endpoints_file:
+        try:
+            with open(args.endpoints_file) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        args.endpoint.append(line)
+        except IOError as err:
+            parser.error(str(err))
+    if not args.endpoint:
+        args.endpoint.append(f"http://localhost:{args.port}")
+    return(args)
 
 
-def get_alerts(args):
+def get_session():
     '''
-    Request all alert rules from the Prometheus API
+    One pooled session per worker thread
+
+    Returns
+    =======
+        session: ``object`` requests.Session() object
     '''
-    try:
-        r = requests.get(
-            f"http://localhost:{args.port}/api/v1/rules?type=alert",
-            headers={'content-type': 'application/json'}
-        )
-        return(r.json())
-    except Exception as err:
-        print(str(err))
+    if not hasattr(local, 'session'):
+        local.session = requests.Session()
+        local.session.headers.update({'content-type': 'application/json'})
+    return(local.session)
 
 
-def write_to_csv(args, alerts):
+def get_params(args):
     '''
-    Write alert data out to a CSV file
+    Query parameters for /api/v1/rules
+
+    Returns
+    =======
+        params: ``list`` list of (key, value) tuples
     '''
-    columns = ['alert', 'query']
-    rows = []
-    for group in alerts['data']['groups']:
-        for alert in group['rules']:
-            tmp = {}
-            tmp['alert'] = alert['name']
-            tmp['query'] = alert['query']
-            rows.append(tmp)
+    params = []
+    if args.type != 'all':
+        params.append(('type', args.type))
+    for group in args.group:
+        params.append(('rule_group[]', group))
+    for match in args.match:
+        params.append(('match[]', match))
+    if args.group_limit:
+        params.append(('group_limit', args.group_limit))
+    return(params)
 
-    try:
-        with open('openshift_alerts.csv', 'w') as f:
-            writer = csv.DictWriter(f, fieldnames=columns)
-            writer.writeheader()
+
+def get_groups(args, endpoint):
+    '''
+    Request the rule groups from one Prometheus API, a page at a time when
+    --group-limit is set
+
+    Returns
+    =======
+        groups: ``generator`` rule group dictionaries as they are parsed
+    '''
+    session = get_session()
+    params = get_params(args)
+    token = None
+    while True:
+        page = params + ([('group_next_token', token)] if token else [])
+        with session.get(f"{endpoint.rstrip('/')}/api/v1/rules", params=page,
+                         timeout=args.timeout, stream=True) as r:
+            r.raise_for_status()
+            if ijson is not None and not args.group_limit:
+                # Groups are handed over as soon as each one is parsed
+                r.raw.decode_content = True
+                yield from ijson.items(r.raw, 'data.groups.item',
+                                       use_float=True)
+                return
+            data = r.json()['data']
+        yield from data['groups']
+        token = data.get('groupNextToken')
+        if not token:
+            return
+
+
+def get_rows(endpoint, group):
+    '''
+    Flatten a rule group into one row per rule
+
+    Returns
+    =======
+        rows: ``generator`` row dictionaries
+    '''
+    for rule in group['rules']:
+        yield({
+            'alert': rule['name'],
+            'query': rule['query'],
+            'endpoint': endpoint,
+            'group': group['name'],
+            'file': group.get('file'),
+            'interval': group.get('interval'),
+            'type': rule.get('type'),
+            'duration': rule.get('duration'),
+            'labels': rule.get('labels', {}),
+            'annotations': rule.get('annotations', {}),
+            'health': rule.get('health'),
+            'lastError': rule.get('lastError'),
+            'lastEvaluation': rule.get('lastEvaluation'),
+            'evaluationTime': rule.get('evaluationTime')
+        })
+
+
+class RowWriter():
+    '''
+    Writes rows from every endpoint to one CSV or JSON lines file
+    '''
+    def __init__(self, args, fields=columns):
+        self.format = args.format
+        self.lock = threading.Lock()
+        if args.output == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(args.output, 'w', newline='')
+        if self.format == 'csv':
+            self.writer = csv.DictWriter(self.file, fieldnames=fields)
+            self.writer.writeheader()
+
+    def write(self, rows):
+        with self.lock:
             for row in rows:
-                writer.writerow(row)
-    except IOError as err:
-        print(str(err))
+                if self.format == 'csv':
+                    # Nested fields are kept as JSON inside the cell
+                    row['labels'] = json.dumps(row['labels'], sort_keys=True)
+                    row['annotations'] = json.dumps(row['annotations'],
+                                                    sort_keys=True)
+                    self.writer.writerow(row)
+                else:
+                    self.file.write(json.dumps(row) + '\n')
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+def export_endpoint(args, endpoint, writer):
+    '''
+    Stream every rule of one endpoint to the writer
+
+    Returns
+    =======
+        count: ``int`` number of rules written
+    '''
+    count = 0
+    for group in get_groups(args, endpoint):
+        rows = list(get_rows(endpoint, group))
+        writer.write(rows)
+        count += len(rows)
+    return(count)
+
+
+def collect_profile(args, endpoint):
+    '''
+    Collect the evaluation cost of every group and rule of one endpoint
+
+    Returns
+    =======
+        profile: ``tuple`` list of group dictionaries, list of rule rows
+    '''
+    groups = []
+    rules = []
+    for group in get_groups(args, endpoint):
+        groups.append({
+            'endpoint': endpoint,
+            'group': group['name'],
+            'file': group.get('file'),
+            'interval': group.get('interval') or 0,
+            'evaluationTime': group.get('evaluationTime') or 0,
+            'lastEvaluation': group.get('lastEvaluation'),
+            'rules': len(group['rules'])
+        })
+        rules.extend(get_rows(endpoint, group))
+    return(groups, rules)
+
+
+def replay_rule(args, row):
+    '''
+    Run a rule's query once through /api/v1/query with query stats
+
+    Returns
+    =======
+        row: ``dict`` the rule row with the replay timings added
+    '''
+    session = get_session()
+    start = time.time()
+    r = session.get(f"{row['endpoint'].rstrip('/')}/api/v1/query",
+                    params={'query': row['query'], 'stats': 'all'},
+                    timeout=args.timeout)
+    row['replayTime'] = round(time.time() - start, 6)
+    r.raise_for_status()
+    data = r.json()
+    # stats comes back inside data from Prometheus 2.35+, Thanos leaves it out
+    stats = data['data'].get('stats', {})
+    row['evalTotalTime'] = stats.get('timings', {}).get('evalTotalTime')
+    row['samples'] = stats.get('samples', {}).get('totalQueryableSamples')
+    row['series'] = len(data['data'].get('result') or [])
+    return(row)
+
+
+def print_profile(args, groups, rules):
+    '''
+    Print the most expensive groups and rules, and the groups that are
+    close to running out of their interval
+    '''
+    print(f"Most expensive groups (top {args.top} of {len(groups)})")
+    print(f"{'eval s':>10} {'interval':>9} {'used':>6} {'rules':>6}  group")
+    for g in sorted(groups, key=lambda g: -g['evaluationTime'])[:args.top]:
+        used = g['evaluationTime'] / g['interval'] if g['interval'] else 0
+        print(f"{g['evaluationTime']:>10.4f} {g['interval']:>9} {used:>6.0%} "
+              f"{g['rules']:>6}  {g['endpoint']} {g['group']}")
+
+    # A group that overruns its interval skips evaluations
+    busy = [g for g in groups if g['interval'] and
+            g['evaluationTime'] >= g['interval'] * args.ratio]
+    print(f"\nGroups using {args.ratio:.0%} or more of their interval: {len(busy)}")
+    for g in sorted(busy, key=lambda g: -g['evaluationTime'] / g['interval']):
+        print(f"{g['evaluationTime']:>10.4f} {g['interval']:>9} "
+              f"{g['evaluationTime'] / g['interval']:>6.0%} "
+              f"{g['rules']:>6}  {g['endpoint']} {g['group']} ({g['file']})")
+
+    print(f"\nMost expensive rules (top {args.top} of {len(rules)})")
+    header = f"{'eval s':>10}"
+    if args.replay:
+        header += f" {'replay s':>9} {'samples':>12} {'series':>7}"
+    print(header + "  rule")
+    for r in sorted(rules, key=lambda r: -(r['evaluationTime'] or 0))[:args.top]:
+        line = f"{r['evaluationTime'] or 0:>10.4f}"
+        if args.replay:
+            line += (f" {r.get('replayTime') or 0:>9.4f}"
+                     f" {r.get('samples') or 0:>12} {r.get('series') or 0:>7}")
+        print(f"{line}  {r['endpoint']} {r['group']}/{r['alert']}")
+
+
+def run_profile(args):
+    '''
+    Profile rule evaluation cost across every endpoint
+
+    Returns
+    =======
+        failed: ``bool`` True if any endpoint or replay failed
+    '''
+    groups = []
+    rules = []
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(collect_profile, args, endpoint): endpoint
+            for endpoint in args.endpoint
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                endpoint_groups, endpoint_rules = future.result()
+                groups.extend(endpoint_groups)
+                rules.extend(endpoint_rules)
+            except Exception as err:
+                print(f"{futures[future]}: {err}", file=sys.stderr)
+                failed = True
+        if args.replay:
+            futures = {pool.submit(replay_rule, args, row): row for row in rules}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as err:
+                    row = futures[future]
+                    print(f"{row['endpoint']} {row['alert']}: {err}",
+                          file=sys.stderr)
+                    failed = True
+    print_profile(args, groups, rules)
+    if args.output:
+        fields = columns + replay_columns if args.replay else columns
+        writer = RowWriter(args, fields)
+        writer.write(rules)
+        writer.close()
+    return(failed)
 
 
 def main():
@@ -73,8 +430,31 @@ def main():
     Welcome to the party pal!!
     '''
     args = get_args()
-    alerts = get_alerts(args)
-    write_to_csv(args, alerts)
+    if args.profile:
+        if run_profile(args):
+            sys.exit(1)
+        return
+    try:
+        writer = RowWriter(args)
+    except IOError as err:
+        print(str(err))
+        sys.exit(1)
+    failed = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(export_endpoint, args, endpoint, writer): endpoint
+            for endpoint in args.endpoint
+        }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                count = future.result()
+                print(f"{futures[future]}: {count} rules", file=sys.stderr)
+            except Exception as err:
+                print(f"{futures[future]}: {err}", file=sys.stderr)
+                failed = True
+    writer.close()
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()